@@ -0,0 +1,99 @@
+import argparse
+import time
+
+import torch
+
+from src.config.config import get_cfg_defaults
+from src.data.dataset import create_dataloaders
+from src.modeling.module import MultiTask
+from src.tool.evaluate import evaluate
+from src.tool.weights import load_weights, needs_pretrained
+
+METHODS = ['none', 'pool', 'merge', 'topk']
+
+
+def method_cfg(cfg, method):
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.MODEL.TRANSFORMER.TOKEN_REDUCTION.METHOD = method
+    cfg.freeze()
+    return cfg
+
+
+def measure_throughput(netD, img_size, device, batch_size, iterations):
+    """
+    Evaluator pairs per second and number of transformer tokens, on random backbone features of the configured size
+    """
+    feats = tuple(torch.randn(batch_size, *shape, device=device) for shape in netD.backbone.output_shapes(img_size))
+
+    evaluator = netD.evaluator
+    with torch.no_grad():
+        if hasattr(evaluator, 'token_reduction'):
+            tokens = evaluator.feat_proj.forward_feat(feats)
+            num_tokens = evaluator.token_reduction(evaluator.feat_proj.embed(tokens), evaluator.feat_proj.embed(tokens),
+                                                   tokens)[0].size(1)
+        else:
+            num_tokens = 0
+
+        for _ in range(3):
+            netD.forward_features(feats, feats, heads=False)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            netD.forward_features(feats, feats, heads=False)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    return batch_size * iterations / (time.perf_counter() - start), num_tokens
+
+
+def main(args, cfg):
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    weights = dict(entry.split('=', 1) for entry in args.weights)
+    dataloaders = create_dataloaders(cfg, phase='eval')[0] if weights else None
+
+    for method in args.methods:
+        cfg_method = method_cfg(cfg, method)
+
+        netD = MultiTask(cfg_method, pretrained=method in weights and needs_pretrained(weights[method])).to(device)
+        netD.eval()
+
+        throughput, num_tokens = measure_throughput(netD, cfg.DATASETS.IMG_SIZE, device, args.batch_size,
+                                                    args.iterations)
+        line = f'{method}: {num_tokens} tokens, {throughput:.1f} pairs/s'
+
+        if method in weights:
+            load_weights(netD, weights[method], map_location=device)
+            result = evaluate(dataloaders['val'], netD, device, cfg.DATASETS.CHANNELS_LAST)
+            line += f', PLCC {result["PLCC"]:.4f}, SRCC {result["SRCC"]:.4f}, KRCC {result["KRCC"]:.4f}'
+
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--config', type=str, help='Configuration YAML file of a transformer-based model')
+    parser.add_argument('--methods', nargs='+', default=METHODS, choices=METHODS, help='Token reductions to compare')
+    parser.add_argument('--batch_size', default=8, type=int, help='Number of pairs per evaluator call')
+    parser.add_argument('--iterations', default=20, type=int, help='Number of timed evaluator calls')
+    parser.add_argument('--weights', nargs='*', default=[],
+                        help='<method>=<netD_path> weights trained with that token reduction, evaluated on PIPAL val')
+    args = parser.parse_args()
+
+    cfg = get_cfg_defaults()
+    try:
+        cfg.merge_from_file(args.config)
+    except:
+        print('Using default configuration file')
+
+    assert cfg.MODEL.BACKBONE.NAME in ['VGG16', 'InceptionResNetV2']
+    assert cfg.MODEL.BACKBONE.FEAT_LEVEL in ['low', 'medium', 'high', 'mixed', 'reduced mixed']
+    assert cfg.MODEL.EVALUATOR in ['IQT', 'Transformer']
+
+    cfg.freeze()
+
+    main(args, cfg)
@@ -0,0 +1,56 @@
+import argparse
+import os
+from pathlib import Path
+
+import numpy as np
+
+from src.data.dataset import LIVE, TID2013, PIPAL
+from src.data.pack import PACKED_DIR, pack_datasets
+from src.data.shards import SHARDS_DIR, write_shards
+
+
+def main(args):
+    if args.dataset == 'PIPAL':
+        root_dir = Path(args.root_dir or '../data/PIPAL(processed)')
+        datasets = {split: PIPAL(root_dir=root_dir, dataset_type=split, mode='eval')
+                    for split in ['train', 'val', 'test']}
+
+    elif args.dataset == 'LIVE':
+        root_dir = args.root_dir or '../data/LIVE'
+        datasets = {'all': LIVE(root_dir=root_dir)}
+
+    else:
+        root_dir = args.root_dir or '../data/TID2013'
+        datasets = {'all': TID2013(root_dir=root_dir)}
+
+    if args.format == 'packed':
+        pack_datasets(datasets, args.output or os.path.join(root_dir, PACKED_DIR))
+
+    else:
+        # Shards are read sequentially, so the PIPAL splits are written in the order pred.py records them
+        orders = {}
+        if args.dataset == 'PIPAL':
+            for split, dataset in datasets.items():
+                dist_names = np.array([dataset.dist_path(idx) for idx in range(len(dataset))])
+                orders[split] = np.argsort(dist_names, kind='stable')
+
+        write_shards(datasets, args.output or os.path.join(root_dir, SHARDS_DIR), args.shard_size, orders)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dataset',
+                        default='PIPAL',
+                        choices=['PIPAL', 'LIVE', 'TID2013'],
+                        help='Dataset to be converted')
+    parser.add_argument('--root_dir', default='', type=str, help='Root directory of the dataset')
+    parser.add_argument('--format',
+                        default='packed',
+                        choices=['packed', 'shards'],
+                        help='Random-access packed store or sequential tar shards')
+    parser.add_argument('--shard_size', default=1000, type=int, help='Number of pairs per shard')
+    parser.add_argument('--output', default='', type=str, help='Output directory, <root_dir>/<format> by default')
+    args = parser.parse_args()
+
+    main(args)
@@ -1,58 +1,102 @@
 import argparse
 
 import torch
-from torch.utils.data import DataLoader
 
 from src.config.config import get_cfg_defaults
-from src.data.dataset import create_dataloaders, LIVE, TID2013
+from src.data.dataset import create_dataloaders, create_eval_dataset, create_eval_dataloader, \
+    create_feature_dataloader
 from src.modeling.module import MultiTask
+from src.modeling.precision import PRECISION_TOLERANCE
 from src.tool.evaluate import evaluate
+from src.tool.export import compile_netD, is_scorer, load_scorer
+from src.tool.weights import load_weights, needs_pretrained
+
+
+def evaluate_precision(dataloader, netD, device, cfg, check_precision=False):
+    """
+    evaluate() in MODEL.PRECISION and, with ``check_precision``, also in float32, printing the differences and whether
+    PLCC and SRCC stay within PRECISION_TOLERANCE of float32
+    """
+    result = evaluate(dataloader, netD, device, cfg.DATASETS.CHANNELS_LAST)
+    if not check_precision:
+        return result, True
+
+    precision, netD.precision = netD.precision, 'fp32'
+    reference = evaluate(dataloader, netD, device, cfg.DATASETS.CHANNELS_LAST)
+    netD.precision = precision
+
+    within = True
+    for metric in ['PLCC', 'SRCC', 'KRCC']:
+        difference = result[metric] - reference[metric]
+        print(f'{metric}: fp32 {reference[metric]:.4f}, {precision} {result[metric]:.4f}, difference {difference:+.4f}')
+        if metric != 'KRCC' and abs(difference) > PRECISION_TOLERANCE:
+            within = False
+    return result, within
 
 
 def main(args, cfg):
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-    netD = MultiTask(cfg).to(device)
-    netD.load_state_dict(torch.load(args.netD_path))
+    if is_scorer(args.netD_path):
+        # A scorer archive of export.py or quantize.py, the quantized ones only run on CPU
+        netD = load_scorer(args.netD_path, device)
+        device = netD.device
+    else:
+        memory_format = torch.channels_last if cfg.DATASETS.CHANNELS_LAST else torch.contiguous_format
+        # Every weight comes from netD_path, unless its compact weights leave out the frozen pretrained backbone
+        netD = MultiTask(cfg, pretrained=needs_pretrained(args.netD_path)).to(device, memory_format=memory_format)
+        load_weights(netD, args.netD_path, map_location=device)
+        if args.compile:
+            compile_netD(netD)
+
+    # Scorer archives are exported in float32
+    check_precision = args.check_precision and cfg.MODEL.PRECISION != 'fp32' and not is_scorer(args.netD_path)
+    within = True
 
     if args.dataset == 'PIPAL':
         dataloaders, datasets_size = create_dataloaders(cfg, phase='eval')
 
         results = {}
         for mode in ['train', 'val', 'test']:
-            results[mode] = evaluate(dataloaders[mode], netD, device)
+            # Cached backbone features of the evaluation crops, when enabled
+            dataloader = create_feature_dataloader(cfg, dataloaders[mode].dataset, netD.backbone, device) or \
+                         dataloaders[mode]
             print(f'{mode}')
+            results[mode], mode_within = evaluate_precision(dataloader, netD, device, cfg, check_precision)
+            within = within and mode_within
             print(f'PLCC: {results[mode]["PLCC"]}')
             print(f'SRCC: {results[mode]["SRCC"]}')
             print(f'KRCC: {results[mode]["KRCC"]}')
 
     else:
-        if args.dataset == 'LIVE':
-            dataset = LIVE(root_dir='../data/LIVE', img_size=cfg.DATASETS.IMG_SIZE)
+        dataset = create_eval_dataset(cfg, args.dataset)
 
-        else:
-            dataset = TID2013(root_dir='../data/TID2013', img_size=cfg.DATASETS.IMG_SIZE)
+        dataloader = create_feature_dataloader(cfg, dataset, netD.backbone, device) or \
+                     create_eval_dataloader(cfg, dataset)
 
-        dataloader = DataLoader(dataset,
-                                batch_size=cfg.DATASETS.BATCH_SIZE,
-                                shuffle=False,
-                                num_workers=cfg.DATASETS.NUM_WORKERS)
-
-        result = evaluate(dataloader, netD, device)
+        result, within = evaluate_precision(dataloader, netD, device, cfg, check_precision)
         print(f'PLCC: {result["PLCC"]}')
         print(f'SRCC: {result["SRCC"]}')
         print(f'KRCC: {result["KRCC"]}')
 
+    if check_precision and not within:
+        raise SystemExit(f'{cfg.MODEL.PRECISION} moves PLCC or SRCC by more than {PRECISION_TOLERANCE} from fp32')
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--config', type=str, help='Configuration YAML file for evaluating')
-    parser.add_argument('--netD_path', required=True, type=str, help='Load model path')
+    parser.add_argument('--netD_path', required=True, type=str,
+                        help='Load model path, netD weights or a scorer archive')
     parser.add_argument('--dataset',
                         default='PIPAL',
                         choices=['PIPAL', 'LIVE', 'TID2013'],
                         help='Dataset to be evaluated')
+    parser.add_argument('--compile', action='store_true', help='Compile netD weights with torch.compile, if available')
+    parser.add_argument('--check_precision', action='store_true',
+                        help='Also evaluate in fp32, and fail if MODEL.PRECISION moves PLCC or SRCC beyond '
+                             'PRECISION_TOLERANCE')
     args = parser.parse_args()
 
     cfg = get_cfg_defaults()
@@ -64,6 +108,8 @@ if __name__ == '__main__':
     assert cfg.MODEL.BACKBONE.NAME in ['VGG16', 'InceptionResNetV2']
     assert cfg.MODEL.BACKBONE.FEAT_LEVEL in ['low', 'medium', 'high', 'mixed', 'reduced mixed']
     assert cfg.MODEL.EVALUATOR in ['IQT', 'DISTS', 'Transformer']
+    assert cfg.MODEL.PRECISION in ['fp32', 'bf16', 'fp16']
+    assert cfg.DATASETS.BACKEND in ['image', 'packed', 'shards']
 
     cfg.freeze()
 
@@ -0,0 +1,79 @@
+import argparse
+import time
+
+import torch
+
+from src.config.config import get_cfg_defaults
+from src.modeling.module import MultiTask
+from src.tool.export import Scorer, export_onnx, load_scorer, save_scorer
+from src.tool.weights import load_weights, needs_pretrained
+
+
+def measure_latency(scorer, ref_img, dist_img, iterations):
+    """
+    Mean seconds per call of ``scorer``, after a few warm-up calls
+    """
+    with torch.no_grad():
+        for _ in range(3):
+            scorer(ref_img, dist_img)
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            scorer(ref_img, dist_img)
+        return (time.perf_counter() - start) / iterations
+
+
+def main(args, cfg):
+    # Traced on CPU, a TorchScript archive is moved to the device it runs on when loaded
+    device = torch.device('cpu')
+
+    netD = MultiTask(cfg, pretrained=needs_pretrained(args.netD_path))
+    load_weights(netD, args.netD_path, map_location=device)
+    netD.eval()
+
+    if args.format == 'onnx':
+        export_onnx(netD, args.output, cfg.DATASETS.IMG_SIZE)
+        return
+
+    save_scorer(netD, args.output, cfg.DATASETS.IMG_SIZE)
+
+    if args.benchmark:
+        # Batch size 1, the online shape
+        ref_img = torch.randn(1, 3, *cfg.DATASETS.IMG_SIZE)
+        dist_img = torch.randn(1, 3, *cfg.DATASETS.IMG_SIZE)
+
+        eager = measure_latency(Scorer(netD).eval(), ref_img, dist_img, args.benchmark)
+        scripted = measure_latency(load_scorer(args.output).module, ref_img, dist_img, args.benchmark)
+        print(f'Eager: {eager * 1000:.2f} ms, TorchScript: {scripted * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--config', type=str, help='Configuration YAML file of the model')
+    parser.add_argument('--netD_path', required=True, type=str, help='Load model path')
+    parser.add_argument('--format',
+                        default='torchscript',
+                        choices=['torchscript', 'onnx'],
+                        help='TorchScript scorer archive, which eval.py and pred.py run, or ONNX')
+    parser.add_argument('--output', default='netD_scorer.pt', type=str, help='Output file of the exported scorer')
+    parser.add_argument('--benchmark', default=0, type=int,
+                        help='Compare the CPU latency of eager and TorchScript scoring over this many calls')
+    args = parser.parse_args()
+
+    cfg = get_cfg_defaults()
+    try:
+        cfg.merge_from_file(args.config)
+    except:
+        print('Using default configuration file')
+
+    # The exported graph is traced in float32
+    cfg.MODEL.PRECISION = 'fp32'
+
+    assert cfg.MODEL.BACKBONE.NAME in ['VGG16', 'InceptionResNetV2']
+    assert cfg.MODEL.BACKBONE.FEAT_LEVEL in ['low', 'medium', 'high', 'mixed', 'reduced mixed']
+    assert cfg.MODEL.EVALUATOR in ['IQT', 'DISTS', 'Transformer']
+
+    cfg.freeze()
+
+    main(args, cfg)
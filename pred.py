@@ -1,135 +1,122 @@
 import argparse
-import os
 import pickle
-from pathlib import Path
 
-import pandas as pd
-import scipy.io as sio
+import numpy as np
 import torch
-import torchvision.transforms.functional as TF
-from PIL import Image
+from torch.utils.data import IterableDataset, Subset
 from tqdm import tqdm
 
 from src.config.config import get_cfg_defaults
+from src.data.dataset import create_dataset, create_eval_dataset, create_eval_dataloader, create_feature_dataloader, \
+    attach_ref_cache, get_ref_keys
+from src.data.features import ReferenceStore, is_feature_loader
+from src.data.prefetcher import DevicePrefetcher
+from src.data.sampler import shares_reference
+from src.data.transforms import normalize
 from src.modeling.module import MultiTask
+from src.tool.evaluate import forward_eval_batch, forward_prepared_batch
+from src.tool.export import compile_netD, is_scorer, load_scorer
+from src.tool.weights import load_weights, needs_pretrained
 
 
-def get_PIPAL_df(dataset_type):
-    root_dir = Path('../data/PIPAL(processed)')
+def get_PIPAL_dataset(cfg, dataset_type):
+    dataset = create_dataset(cfg, cfg.DATASETS.ROOT_DIR, dataset_type, mode='eval')
+    if cfg.DATASETS.BACKEND == 'image':
+        attach_ref_cache([dataset], cfg.DATASETS.REF_CACHE_BYTES)
 
-    label_dir = {'train': 'Train_Label', 'val': 'Val_Label', 'test': 'Test_Label'}
+    # convert.py already writes the PIPAL shards in the order of the distorted image names
+    if isinstance(dataset, IterableDataset):
+        return dataset
 
-    tmp_df = []
-    for filename in (root_dir / label_dir[dataset_type]).glob('*.txt'):
-        df = pd.read_csv(filename, index_col=None, header=None, names=['dist_img', 'score'])
-        tmp_df.append(df)
+    # Predictions are recorded in the order of the distorted image names
+    dist_names = np.array([dataset.dist_path(idx) for idx in range(len(dataset))])
+    return Subset(dataset, np.argsort(dist_names, kind='stable'))
 
-    df = pd.concat(tmp_df, axis=0, ignore_index=True)
 
-    df['ref_img'] = df['dist_img'].apply(lambda x: root_dir / f'Ref/{x[:5] + x[-4:]}')
-    df['dist_img'] = df['dist_img'].apply(lambda x: root_dir / f'Dist/{x}')
-    df = df[['dist_img', 'ref_img']].sort_values('dist_img')
+def get_ref_paths(dataset):
+    """
+    Path of the reference image of every pair of ``dataset``
+    """
+    base = dataset.dataset if isinstance(dataset, Subset) else dataset
+    return [base.image_path(ref_id) for ref_id in np.asarray(get_ref_keys(dataset)).tolist()]
 
-    return df
 
+def get_pred_scores(dataset, netD, cfg, device, ref_store=None):
+    # Several workers would interleave the shards, a single one keeps them in the written order
+    if isinstance(dataset, IterableDataset):
+        cfg = cfg.clone()
+        cfg.defrost()
+        cfg.DATASETS.NUM_WORKERS = min(cfg.DATASETS.NUM_WORKERS, 1)
 
-def get_LIVE_df():
-    root_dir = '../data/LIVE'
-    num_type_map = {
-        'jp2k': 227,
-        'jpeg': 233,
-        'wn': 174,
-        'gblur': 174,
-        'fastfading': 174
-    }
+    dataloader = create_feature_dataloader(cfg, dataset, netD.backbone, device) or create_eval_dataloader(cfg, dataset)
+    shared_ref = shares_reference(dataloader)
+    cached = is_feature_loader(dataloader)
 
-    dist_path_list = []
-    for dist_type, num_dist in num_type_map.items():
-        for i in range(1, num_dist + 1):
-            dist_path_list.append(os.path.join(dist_type, f'img{i}.bmp'))
-
-    refnames_all = sio.loadmat(os.path.join(root_dir, 'refnames_all.mat'))['refnames_all']
-
-    df = pd.DataFrame({'ref_img': refnames_all[0], 'dist_img': dist_path_list})
-    df['ref_img'] = df['ref_img'].apply(lambda x: os.path.join(root_dir, f'refimgs/{x[0]}'))
-    df['dist_img'] = df['dist_img'].apply(lambda x: os.path.join(root_dir, f'{x}'))
-
-    return df
-
-
-def get_TID2013_df():
-    root_dir = '../data/TID2013'
-    df = pd.read_csv(os.path.join(root_dir, 'mos.csv'))
-
-    df['ref_img'] = df['ref_img'].apply(lambda x: os.path.join(root_dir, 'reference_images', f'{x}'))
-    df['dist_img'] = df['dist_img'].apply(lambda x: os.path.join(root_dir, 'distorted_images', f'{x}'))
-
-    return df
-
-
-def get_pred_scores(df, netD, img_size, device):
-    def transform(ref_img, dist_img, img_size):
-        ref_imgs = TF.five_crop(ref_img, img_size)
-        dist_imgs = TF.five_crop(dist_img, img_size)
-
-        ref_imgs = torch.stack([TF.normalize(TF.to_tensor(crop), [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]) for crop
-                                in
-                                ref_imgs])
-        dist_imgs = torch.stack([TF.normalize(TF.to_tensor(crop), [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]) for crop
-                                 in
-                                 dist_imgs])
-
-        return ref_imgs, dist_imgs
+    # Prepared references replace the reference backbone passes of batches grouped by reference
+    if ref_store is not None and shared_ref and not cached:
+        ref_paths = get_ref_paths(dataset)
+        batch_ref_paths = iter([ref_paths[batch[0]] for batch in dataloader.batch_sampler])
+    else:
+        batch_ref_paths = None
 
     pred_scores_list = []
 
-    for index, data in tqdm(df.iterrows()):
-        ref_img = Image.open(data['ref_img']).convert('RGB')
-        dist_img = Image.open(data['dist_img']).convert('RGB')
-        ref_img, dist_img = transform(ref_img, dist_img, img_size)
-
-        ref_img = ref_img.to(device)
-        dist_img = dist_img.to(device)
-
-        # Format batch
-        ncrops, c, h, w = ref_img.size()
-
+    for ref_imgs, dist_imgs, _, _, _ in tqdm(DevicePrefetcher(dataloader, device, cfg.DATASETS.CHANNELS_LAST)):
         with torch.no_grad():
             """
             Evaluate distorted images
             """
-            _, _, pred_scores = netD(ref_img.view(-1, c, h, w), dist_img.view(-1, c, h, w))
-            pred_scores_avg = pred_scores.view(1, ncrops, -1).mean(1).view(-1)
+            if batch_ref_paths is not None:
+                prepared = ref_store.get(next(batch_ref_paths), lambda: netD.prepare_reference(normalize(ref_imgs[0])),
+                                         device)
+                _, _, pred_scores_avg = forward_prepared_batch(netD, prepared, dist_imgs, heads=False)
+            else:
+                _, _, pred_scores_avg = forward_eval_batch(netD, ref_imgs, dist_imgs, shared_ref, cached, heads=False)
 
             # Record original predict scores
-            pred_scores_list.append(pred_scores_avg.cpu().detach())
+            pred_scores_list.append(pred_scores_avg.view(-1).detach())
 
-    pred_scores_arr = torch.cat(pred_scores_list).numpy()
+    pred_scores_arr = np.empty(len(dataset), dtype=np.float32)
+
+    # Grouped batches do not follow the dataset order
+    if shared_ref:
+        order = [idx for batch in dataloader.batch_sampler for idx in batch]
+    else:
+        order = np.arange(len(dataset))
+    pred_scores_arr[order] = torch.cat(pred_scores_list).cpu().numpy()
 
     return pred_scores_arr
 
 
 def main(args, cfg):
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    img_size = cfg.DATASETS.IMG_SIZE
 
-    netD = MultiTask(cfg).to(device)
-    netD.load_state_dict(torch.load(args.netD_path))
+    if is_scorer(args.netD_path):
+        # A scorer archive of export.py or quantize.py, the quantized ones only run on CPU
+        netD = load_scorer(args.netD_path, device)
+        device = netD.device
+    else:
+        memory_format = torch.channels_last if cfg.DATASETS.CHANNELS_LAST else torch.contiguous_format
+        # Every weight comes from netD_path, unless its compact weights leave out the frozen pretrained backbone
+        netD = MultiTask(cfg, pretrained=needs_pretrained(args.netD_path)).to(device, memory_format=memory_format)
+        load_weights(netD, args.netD_path, map_location=device)
+        if args.compile:
+            compile_netD(netD)
     netD.eval()
 
+    # Scorer archives only run whole pairs
+    ref_store = None
+    if args.reference_cache and not is_scorer(args.netD_path):
+        ref_store = ReferenceStore(args.reference_cache, netD, cfg.DATASETS.IMG_SIZE, cfg.MODEL.PRECISION)
+
     if args.dataset == 'PIPAL':
         records = {}
         for dataset_type in ['train', 'val', 'test']:
-            df = get_PIPAL_df(dataset_type)
-            records[dataset_type] = get_pred_scores(df, netD, img_size, device)
-
-    elif args.dataset == 'LIVE':
-        df = get_LIVE_df()
-        records = get_pred_scores(df, netD, img_size, device)
+            records[dataset_type] = get_pred_scores(get_PIPAL_dataset(cfg, dataset_type), netD, cfg, device,
+                                                    ref_store)
 
     else:
-        df = get_TID2013_df()
-        records = get_pred_scores(df, netD, img_size, device)
+        records = get_pred_scores(create_eval_dataset(cfg, args.dataset), netD, cfg, device, ref_store)
 
     with open(args.output, 'wb') as handle:
         pickle.dump(records, handle)
@@ -139,12 +126,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--config', type=str, help='Configuration YAML file for evaluating')
-    parser.add_argument('--netD_path', required=True, type=str, help='Load model path')
+    parser.add_argument('--netD_path', required=True, type=str,
+                        help='Load model path, netD weights or a scorer archive')
     parser.add_argument('--output', default='pred_scores.pickle', type=str, help='Output file name of a pickle file')
     parser.add_argument('--dataset',
                         default='PIPAL',
                         choices=['PIPAL', 'LIVE', 'TID2013'],
                         help='Dataset to be evaluated')
+    parser.add_argument('--compile', action='store_true', help='Compile netD weights with torch.compile, if available')
+    parser.add_argument('--reference_cache', default='', type=str,
+                        help='Directory of prepared references, reused by the pairs of every reference across runs '
+                             '(needs DATASETS.GROUP_BY_REF)')
     args = parser.parse_args()
 
     cfg = get_cfg_defaults()
@@ -156,6 +148,8 @@ if __name__ == '__main__':
     assert cfg.MODEL.BACKBONE.NAME in ['VGG16', 'InceptionResNetV2']
     assert cfg.MODEL.BACKBONE.FEAT_LEVEL in ['low', 'medium', 'high', 'mixed', 'reduced mixed']
     assert cfg.MODEL.EVALUATOR in ['IQT', 'DISTS', 'Transformer']
+    assert cfg.MODEL.PRECISION in ['fp32', 'bf16', 'fp16']
+    assert cfg.DATASETS.BACKEND in ['image', 'packed', 'shards']
 
     cfg.freeze()
 
@@ -0,0 +1,90 @@
+import argparse
+import copy
+import json
+
+import torch
+
+from src.config.config import get_cfg_defaults
+from src.data.dataset import create_dataloaders, loader_kwargs
+from src.modeling.module import MultiTask
+from src.tool.evaluate import evaluate
+from src.tool.export import save_scorer
+from src.tool.quantize import calibration_batches, calibration_dataloader, quantize_backbone, quantize_evaluator
+from src.tool.weights import load_weights, needs_pretrained
+
+
+def main(args, cfg):
+    # The INT8 kernels only run on CPU
+    device = torch.device('cpu')
+
+    netD = MultiTask(cfg, pretrained=needs_pretrained(args.netD_path))
+    load_weights(netD, args.netD_path, map_location=device)
+    netD.eval()
+
+    dataloaders, _ = create_dataloaders(cfg, phase='eval')
+
+    netD_int8 = quantize_evaluator(copy.deepcopy(netD))
+    if not args.dynamic_only:
+        calibration_loader = calibration_dataloader(dataloaders['train'].dataset,
+                                                    args.num_calibration,
+                                                    cfg.DATASETS.BATCH_SIZE,
+                                                    seed=args.seed,
+                                                    **loader_kwargs(cfg))
+        quantize_backbone(netD_int8, calibration_batches(calibration_loader, args.num_calibration))
+
+    """
+    Accuracy report
+    """
+    report = {}
+    for mode in args.report_splits:
+        report[mode] = {
+            'fp32': evaluate(dataloaders[mode], netD, device),
+            'int8': evaluate(dataloaders[mode], netD_int8, device)
+        }
+
+        print(f'{mode}')
+        for metric in ['PLCC', 'SRCC', 'KRCC']:
+            fp32, int8 = report[mode]['fp32'][metric], report[mode]['int8'][metric]
+            print(f'{metric}: fp32 {fp32:.4f}, int8 {int8:.4f}, difference {int8 - fp32:+.4f}')
+
+    if args.report:
+        with open(args.report, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+    save_scorer(netD_int8, args.output, cfg.DATASETS.IMG_SIZE, quantized=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--config', type=str, help='Configuration YAML file of the model')
+    parser.add_argument('--netD_path', required=True, type=str, help='Load model path')
+    parser.add_argument('--output', default='netD_int8.pt', type=str, help='Output file of the quantized scorer')
+    parser.add_argument('--num_calibration', default=300, type=int,
+                        help='Number of PIPAL training pairs to calibrate the backbone on')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the random choice of calibration pairs')
+    parser.add_argument('--dynamic_only', action='store_true',
+                        help='Only quantize the evaluator, the backbone stays in float32')
+    parser.add_argument('--report_splits', nargs='+', default=['val'], choices=['train', 'val', 'test'],
+                        help='PIPAL splits the accuracy report compares fp32 and int8 on')
+    parser.add_argument('--report', default='', type=str, help='Also write the accuracy report to this JSON file')
+    args = parser.parse_args()
+
+    cfg = get_cfg_defaults()
+    try:
+        cfg.merge_from_file(args.config)
+    except:
+        print('Using default configuration file')
+
+    # Quantization starts from the float32 model
+    cfg.MODEL.PRECISION = 'fp32'
+    cfg.DATASETS.CHANNELS_LAST = False
+
+    assert cfg.MODEL.BACKBONE.NAME in ['VGG16', 'InceptionResNetV2']
+    assert cfg.MODEL.BACKBONE.FEAT_LEVEL in ['low', 'medium', 'high', 'mixed', 'reduced mixed']
+    assert cfg.MODEL.EVALUATOR in ['IQT', 'DISTS', 'Transformer']
+    assert cfg.DATASETS.BACKEND in ['image', 'packed', 'shards']
+
+    cfg.freeze()
+
+    main(args, cfg)
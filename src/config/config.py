@@ -7,6 +7,23 @@ _C.DATASETS.ROOT_DIR = '../data/PIPAL(processed)'
 _C.DATASETS.NUM_WORKERS = 4
 _C.DATASETS.BATCH_SIZE = 4
 _C.DATASETS.IMG_SIZE = (192, 192)
+# 'image' decodes the original files, 'packed' and 'shards' read the stores written by convert.py under <root>/packed
+# and <root>/shards
+_C.DATASETS.BACKEND = 'image'
+# Number of training pairs in the shuffle buffer of the 'shards' backend
+_C.DATASETS.SHUFFLE_BUFFER = 1000
+# Shared memory budget of the decoded reference image cache, 0 disables it
+_C.DATASETS.REF_CACHE_BYTES = 512 * 1024 ** 2
+# Build evaluation batches from pairs of a single reference, whose features are then computed once per batch
+_C.DATASETS.GROUP_BY_REF = False
+# Pin batches for asynchronous host-to-device copies, ignored without CUDA
+_C.DATASETS.PIN_MEMORY = True
+# Keep the DataLoader workers alive across epochs
+_C.DATASETS.PERSISTENT_WORKERS = True
+# Feed images and run the model in channels_last memory format
+_C.DATASETS.CHANNELS_LAST = False
+# Crop, flip and rotate the training pairs in batch on the model device instead of in the workers
+_C.DATASETS.DEVICE_AUGMENT = False
 
 _C.TRAIN = CN()
 
@@ -17,10 +34,33 @@ _C.TRAIN.NUM_EPOCHS = 5
 
 _C.TRAIN.WEIGHT_DIR = ''
 _C.TRAIN.LOG_DIR = ''
+# 'pth' saves the weights of every epoch with torch.save, 'compact' as memory-mappable .safetensors files
+_C.TRAIN.WEIGHT_FORMAT = 'pth'
+# compact only: leave out the frozen backbone parameters, which are rebuilt from the pretrained backbone on load, so
+# only for frozen backbones that still hold the pretrained weights
+_C.TRAIN.OMIT_FROZEN = True
+# compact only: store the evaluator weights in float16
+_C.TRAIN.HALF_EVALUATOR = False
+# Seed of the training order, which is then the same for every run and can be resumed part way through an epoch
+_C.TRAIN.SEED = 0
+# Save a full checkpoint to WEIGHT_DIR/checkpoint.pth every CHECKPOINT_INTERVAL iterations and after every epoch,
+# 0 disables it
+_C.TRAIN.CHECKPOINT_INTERVAL = 0
 
 _C.TRAIN.RESUME = CN()
 _C.TRAIN.RESUME.NET_D = ''
 _C.TRAIN.RESUME.NET_G = ''
+# Full checkpoint to resume from, down to the iteration, taking precedence over START_EPOCH
+_C.TRAIN.RESUME.CHECKPOINT = ''
+
+# Phase 3 only: train the evaluator on cached backbone features of a fixed crop grid of every PIPAL image, instead of
+# random crops, which needs a fixed backbone and MODEL.BACKBONE.FEATURE_CACHE
+_C.TRAIN.FEATURE_GRID = CN()
+_C.TRAIN.FEATURE_GRID.ENABLED = False
+_C.TRAIN.FEATURE_GRID.STRIDE = 96
+# Counterclockwise rotations by k * 90 degrees of every crop
+_C.TRAIN.FEATURE_GRID.ROTATIONS = (0, 1, 2, 3)
+_C.TRAIN.FEATURE_GRID.FLIP = False
 
 _C.TRAIN.LEARNING_RATE = CN()
 _C.TRAIN.LEARNING_RATE.NET_D = 1e-5
@@ -41,11 +81,20 @@ _C.MODEL = CN()
 _C.MODEL.LATENT_DIM = 100
 _C.MODEL.INCEPTION_DIMS = 2048
 _C.MODEL.EVALUATOR = 'IQT'
+# Autocast precision of the models, 'fp32', 'bf16' or 'fp16' (bfloat16 on CPU, which only supports that)
+_C.MODEL.PRECISION = 'fp32'
 
 _C.MODEL.BACKBONE = CN()
 _C.MODEL.BACKBONE.NAME = 'InceptionResNetV2'
 _C.MODEL.BACKBONE.FEAT_LEVEL = 'low'
 _C.MODEL.BACKBONE.FIXED = True
+# Run the reference and distorted images through the backbone in a single pass over the concatenated batch
+_C.MODEL.BACKBONE.FUSED = True
+# Directory of the on-disk backbone features of the evaluation crops, only used with a fixed backbone, '' disables it
+_C.MODEL.BACKBONE.FEATURE_CACHE = ''
+# Storage dtype of the cached features, 'float32' scores as the uncached path does, 'float16' halves the size but
+# rounds the evaluator inputs
+_C.MODEL.BACKBONE.FEATURE_CACHE_DTYPE = 'float32'
 
 _C.MODEL.TRANSFORMER = CN()
 _C.MODEL.TRANSFORMER.TRANSFORMER_LAYERS = 1
@@ -54,6 +103,14 @@ _C.MODEL.TRANSFORMER.MHA_NUM_HEADS = 4
 _C.MODEL.TRANSFORMER.FEAT_DIM = 1024
 _C.MODEL.TRANSFORMER.HEAD_DIM = 128
 
+# Shortens the token sequences between the feature projection and the transformer: 'none', 'pool' (average pooling of
+# every level over POOL_SIZE x POOL_SIZE windows), 'merge' (learned merging into NUM_TOKENS tokens) or 'topk' (the
+# NUM_TOKENS positions with the largest difference tokens)
+_C.MODEL.TRANSFORMER.TOKEN_REDUCTION = CN()
+_C.MODEL.TRANSFORMER.TOKEN_REDUCTION.METHOD = 'none'
+_C.MODEL.TRANSFORMER.TOKEN_REDUCTION.POOL_SIZE = 2
+_C.MODEL.TRANSFORMER.TOKEN_REDUCTION.NUM_TOKENS = 256
+
 cfg = _C
 
 
@@ -0,0 +1,99 @@
+import multiprocessing as mp
+
+import numpy as np
+import torch
+from PIL import Image
+
+from src.data.region import open_image
+
+
+class SharedReferenceCache:
+    """
+    LRU cache of decoded reference images living in shared memory
+
+    Every DataLoader worker sees the same slots, so each reference is decoded once per run instead of once per pair.
+    Images are stored as uint8 HWC arrays in fixed-size slots large enough for the biggest reference, and the number of
+    slots is bounded by ``max_bytes``. A hit pins its slot while the image is copied out of it, so that the copy runs
+    outside the lock without the slot being evicted meanwhile.
+    """
+
+    def __init__(self, paths, max_bytes):
+        self.keys = {path: key for key, path in enumerate(dict.fromkeys(str(path) for path in paths))}
+
+        # Only the image headers are read here
+        self.shapes = []
+        for path in self.keys:
+            with Image.open(path) as img:
+                self.shapes.append((img.height, img.width))
+
+        slot_height = max((h for h, _ in self.shapes), default=0)
+        slot_width = max((w for _, w in self.shapes), default=0)
+        slot_bytes = max(slot_height * slot_width * 3, 1)
+        num_slots = min(len(self.keys), max_bytes // slot_bytes)
+
+        if num_slots > 0:
+            self.slots = torch.empty((num_slots, slot_height, slot_width, 3), dtype=torch.uint8).share_memory_()
+            self.slot_of_key = torch.full((len(self.keys),), -1, dtype=torch.long).share_memory_()
+            self.key_of_slot = torch.full((num_slots,), -1, dtype=torch.long).share_memory_()
+            self.last_used = torch.zeros(num_slots, dtype=torch.long).share_memory_()
+            # Number of workers copying out of every slot
+            self.pins = torch.zeros(num_slots, dtype=torch.long).share_memory_()
+            self.clock = torch.zeros(1, dtype=torch.long).share_memory_()
+            self.lock = mp.Lock()
+        else:
+            self.slots = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def decode(path):
+        return np.asarray(Image.open(path).convert('RGB'))
+
+    def get(self, path):
+        """
+        Return the decoded reference image at ``path`` as an uint8 HWC array, or as the array-like of
+        ``src.data.region.open_image`` for an image that is not cached
+        """
+        key = self.keys.get(str(path))
+        if self.slots is None or key is None:
+            return open_image(path)
+
+        h, w = self.shapes[key]
+
+        with self.lock:
+            slot = int(self.slot_of_key[key])
+            if slot >= 0:
+                self._touch(slot)
+                self.pins[slot] += 1
+
+        if slot >= 0:
+            # The pinned slot is not evicted while it is copied, and other workers are not held up by the copy
+            try:
+                return self.slots[slot, :h, :w].numpy().copy()
+            finally:
+                with self.lock:
+                    self.pins[slot] -= 1
+
+        # Decode outside the lock so that workers missing different references do not serialize
+        img = self.decode(path)
+
+        with self.lock:
+            # Another worker may have inserted it meanwhile, and every slot may be pinned
+            unpinned = self.pins == 0
+            if int(self.slot_of_key[key]) < 0 and bool(unpinned.any()):
+                slot = int(torch.argmin(self.last_used.masked_fill(~unpinned, self.clock[0] + 1)))
+                evicted = int(self.key_of_slot[slot])
+                if evicted >= 0:
+                    self.slot_of_key[evicted] = -1
+
+                self.slots[slot, :h, :w] = torch.from_numpy(img)
+                self.key_of_slot[slot] = key
+                self.slot_of_key[key] = slot
+                self._touch(slot)
+
+        return img
+
+    def _touch(self, slot):
+        self.clock += 1
+        self.last_used[slot] = self.clock[0]
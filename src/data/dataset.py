@@ -1,3 +1,5 @@
+import io
+import json
 import os
 import random
 from pathlib import Path
@@ -6,115 +8,188 @@ import numpy as np
 import pandas as pd
 import scipy.io as sio
 import torch
-import torchvision.transforms.functional as TF
+import torch.distributed as dist
 from PIL import Image
-from torch.utils.data import Dataset, DataLoader
-from torchvision.transforms import transforms
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Subset, get_worker_info
 
+from src.data.cache import SharedReferenceCache
+from src.data.features import FeatureDataset, FeatureStore, FiveCropPlan, GridCropPlan, GridFeatureDataset
+from src.data.index import PairIndex, cached_index
+from src.data.pack import PACKED_DIR, PackedImages
+from src.data.region import open_image
+from src.data.sampler import ReferenceBatchSampler, ResumableSampler
+from src.data.shards import SHARDS_DIR, iter_shard
+from src.data.transforms import to_tensor, to_uint8_tensor, five_crop, paired_random_transform, stack_crops
 
-class LIVE(Dataset):
-    def __init__(self, root_dir, img_size=(192, 192)):
-        num_type_map = {
-            'jp2k': 227,
-            'jpeg': 233,
-            'wn': 174,
-            'gblur': 174,
-            'fastfading': 174
-        }
+DATASET_ROOTS = {'LIVE': '../data/LIVE', 'TID2013': '../data/TID2013'}
 
-        dist_path_list = []
-        for dist_type, num_dist in num_type_map.items():
-            for i in range(1, num_dist + 1):
-                dist_path_list.append(os.path.join(dist_type, f'img{i}.bmp'))
 
-        refnames_all = sio.loadmat(os.path.join(root_dir, 'refnames_all.mat'))['refnames_all']
-        dmos = sio.loadmat(os.path.join(root_dir, 'dmos.mat'))['dmos']
+def load_image(path, cache=None):
+    """
+    Open an image as an uint8 HWC array-like, whose crops are read without decoding the rest of the file when the
+    format allows it, see ``src.data.region.open_image``
+    """
+    if cache is not None:
+        return cache.get(path)
+    return open_image(path)
 
-        df = pd.DataFrame({'ref_img': refnames_all[0], 'dist_img': dist_path_list, 'dmos': dmos[0]})
-        df['ref_img'] = df['ref_img'].apply(lambda x: os.path.join(root_dir, f'refimgs/{x[0]}'))
-        df['dist_img'] = df['dist_img'].apply(lambda x: os.path.join(root_dir, f'{x}'))
-        # for convenience
-        df['cat'] = 0  # should be changed to its category number
-        df['score'] = 0  # should be changed to its normalization score
 
-        self.df = df
-        self.img_size = img_size
+def eval_transform(ref_img, dist_img, img_size):
+    """
+    Five crops of each image as uint8 (5, C, H, W) tensors, see ``src.data.transforms.normalize``
+    """
+    return stack_crops(five_crop(ref_img, img_size)), stack_crops(five_crop(dist_img, img_size))
 
-    def __len__(self):
-        return len(self.df)
 
-    def __getitem__(self, idx):
-        if torch.is_tensor(idx):
-            idx = idx.tolist()
+def train_transform(ref_img, dist_img, img_size, device_augment=False):
+    """
+    Random crop, horizontal flipping and rotation of a training pair
 
-        ref_img = Image.open(self.df['ref_img'].iloc[idx]).convert('RGB')
-        dist_img = Image.open(self.df['dist_img'].iloc[idx]).convert('RGB')
+    With ``device_augment`` the whole uint8 images are returned instead, to be augmented in batch by
+    ``src.data.transforms.paired_random_augment``.
+    """
+    if device_augment:
+        return to_uint8_tensor(ref_img), to_uint8_tensor(dist_img)
 
-        ref_img, dist_img = self.transform(ref_img, dist_img)
+    ref_img, dist_img = paired_random_transform(ref_img, dist_img, img_size)
+    return to_tensor(ref_img), to_tensor(dist_img)
 
-        return ref_img, dist_img, self.df['score'].iloc[idx], self.df['cat'].iloc[idx], self.df['dmos'].iloc[idx]
 
-    def transform(self, ref_img, dist_img):
-        ref_imgs = TF.five_crop(ref_img, self.img_size)
-        dist_imgs = TF.five_crop(dist_img, self.img_size)
+def attach_ref_cache(datasets, max_bytes):
+    """
+    Share one reference image cache of ``max_bytes`` bytes between ``datasets``
+    """
+    if max_bytes <= 0:
+        return None
 
-        ref_imgs = torch.stack([TF.normalize(TF.to_tensor(crop),
-                                             [0.485, 0.456, 0.406],
-                                             [0.229, 0.224, 0.225])
-                                for crop in ref_imgs])
-        dist_imgs = torch.stack([TF.normalize(TF.to_tensor(crop),
-                                              [0.485, 0.456, 0.406],
-                                              [0.229, 0.224, 0.225])
-                                 for crop in dist_imgs])
+    ref_paths = [dataset.index.path(ref_id) for dataset in datasets for ref_id in np.unique(dataset.ref_ids)]
+    ref_cache = SharedReferenceCache(ref_paths, max_bytes)
+    for dataset in datasets:
+        dataset.ref_cache = ref_cache
 
-        return ref_imgs, dist_imgs
+    return ref_cache
 
 
-class TID2013(Dataset):
-    def __init__(self, root_dir, img_size=(192, 192)):
-        df = pd.read_csv(os.path.join(root_dir, 'mos.csv'))
+class IQADataset(Dataset):
+    """
+    A base class for datasets of (reference, distorted) pairs described by a PairIndex
+    """
 
-        df['ref_img'] = df['ref_img'].apply(lambda x: os.path.join(root_dir, 'reference_images', f'{x}'))
-        df['dist_img'] = df['dist_img'].apply(lambda x: os.path.join(root_dir, 'distorted_images', f'{x}'))
-        # for convenience
-        df['cat'] = 0  # should be changed to its category number
-        df['score'] = 0  # should be changed to its normalization score
+    def __init__(self, index, scores, mode='eval', img_size=(192, 192)):
+        self.index = index
+        self.scores = scores
+        self.categories = index.categories
+        self.origin_scores = index.origin_scores
 
-        self.df = df
+        self.mode = mode
         self.img_size = img_size
+        self.ref_cache = None
+
+    @property
+    def ref_ids(self):
+        return self.index.ref_ids
+
+    @property
+    def dist_ids(self):
+        return self.index.dist_ids
+
+    @property
+    def num_images(self):
+        return self.index.num_paths
+
+    def image_path(self, image_id):
+        return self.index.path(image_id)
+
+    def image(self, image_id):
+        return load_image(self.index.path(image_id), self.ref_cache)
+
+    def dist_path(self, idx):
+        return self.index.dist_path(idx)
 
     def __len__(self):
-        return len(self.df)
+        return len(self.index)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        ref_img = Image.open(self.df['ref_img'].iloc[idx]).convert('RGB')
-        dist_img = Image.open(self.df['dist_img'].iloc[idx]).convert('RGB')
+        ref_img = load_image(self.index.ref_path(idx), self.ref_cache)
+        dist_img = load_image(self.index.dist_path(idx))
 
         ref_img, dist_img = self.transform(ref_img, dist_img)
 
-        return ref_img, dist_img, self.df['score'].iloc[idx], self.df['cat'].iloc[idx], self.df['mos'].iloc[idx]
+        return ref_img, dist_img, self.scores[idx], self.categories[idx], self.origin_scores[idx]
 
     def transform(self, ref_img, dist_img):
-        ref_imgs = TF.five_crop(ref_img, self.img_size)
-        dist_imgs = TF.five_crop(dist_img, self.img_size)
+        return eval_transform(ref_img, dist_img, self.img_size)
 
-        ref_imgs = torch.stack([TF.normalize(TF.to_tensor(crop),
-                                             [0.485, 0.456, 0.406],
-                                             [0.229, 0.224, 0.225])
-                                for crop in ref_imgs])
-        dist_imgs = torch.stack([TF.normalize(TF.to_tensor(crop),
-                                              [0.485, 0.456, 0.406],
-                                              [0.229, 0.224, 0.225])
-                                 for crop in dist_imgs])
 
-        return ref_imgs, dist_imgs
+class LIVE(IQADataset):
+    def __init__(self, root_dir, img_size=(192, 192)):
+        label_files = [os.path.join(root_dir, 'refnames_all.mat'), os.path.join(root_dir, 'dmos.mat')]
+        index = cached_index(root_dir, 'LIVE', label_files, lambda: self.build_index(root_dir))
+
+        # for convenience, should be changed to its normalization score
+        super(LIVE, self).__init__(index, np.zeros(len(index)), img_size=img_size)
+
+    @staticmethod
+    def build_index(root_dir):
+        num_type_map = {
+            'jp2k': 227,
+            'jpeg': 233,
+            'wn': 174,
+            'gblur': 174,
+            'fastfading': 174
+        }
+
+        dist_path_list = []
+        for dist_type, num_dist in num_type_map.items():
+            for i in range(1, num_dist + 1):
+                dist_path_list.append(os.path.join(root_dir, dist_type, f'img{i}.bmp'))
+
+        refnames_all = sio.loadmat(os.path.join(root_dir, 'refnames_all.mat'))['refnames_all']
+        dmos = sio.loadmat(os.path.join(root_dir, 'dmos.mat'))['dmos']
 
+        ref_path_list = [os.path.join(root_dir, 'refimgs', refname[0]) for refname in refnames_all[0]]
 
-class PIPAL(Dataset):
-    def __init__(self, root_dir, dataset_type='train', mode='train', img_size=(192, 192)):
+        return PairIndex.from_paths(ref_path_list, dist_path_list, dmos[0])
+
+
+class TID2013(IQADataset):
+    def __init__(self, root_dir, img_size=(192, 192)):
+        label_files = [os.path.join(root_dir, 'mos.csv')]
+        index = cached_index(root_dir, 'TID2013', label_files, lambda: self.build_index(root_dir))
+
+        # for convenience, should be changed to its normalization score
+        super(TID2013, self).__init__(index, np.zeros(len(index)), img_size=img_size)
+
+    @staticmethod
+    def build_index(root_dir):
+        df = pd.read_csv(os.path.join(root_dir, 'mos.csv'))
+
+        return PairIndex.from_paths(os.path.join(root_dir, 'reference_images', '') + df['ref_img'].astype(str),
+                                    os.path.join(root_dir, 'distorted_images', '') + df['dist_img'].astype(str),
+                                    df['mos'])
+
+
+class PIPAL(IQADataset):
+    def __init__(self, root_dir, dataset_type='train', mode='train', img_size=(192, 192), device_augment=False):
+        label_dir = {'train': 'Train_Label', 'val': 'Val_Label', 'test': 'Test_Label'}
+
+        label_files = sorted((Path(root_dir) / label_dir[dataset_type]).glob('*.txt'))
+        index = cached_index(root_dir, f'PIPAL-{dataset_type}', label_files,
+                             lambda: self.build_index(root_dir, label_files))
+
+        origin_scores = index.origin_scores
+        scores = 1 - ((origin_scores - np.min(origin_scores)) / (np.max(origin_scores) - np.min(origin_scores)))
+
+        super(PIPAL, self).__init__(index, scores, mode=mode, img_size=img_size)
+
+        # train mode ships whole uint8 images, augmented in batch by src.data.transforms.paired_random_augment
+        self.device_augment = device_augment
+
+    @staticmethod
+    def build_index(root_dir, label_files):
         dist_type = {
             '00': 0,
             '01': 12,
@@ -125,39 +200,68 @@ class PIPAL(Dataset):
             '06': 12 + 16 + 10 + 24 + 13 + 14
         }
 
-        label_dir = {'train': 'Train_Label', 'val': 'Val_Label', 'test': 'Test_Label'}
+        df = pd.concat([pd.read_csv(filename, index_col=None, header=None, names=['dist_img', 'score'])
+                        for filename in label_files], axis=0, ignore_index=True)
+
+        dist_names = df['dist_img'].astype(str)
+        categories = dist_names.str[6:8].map(dist_type) + dist_names.str[9:11].astype(int)
 
-        dfs = []
-        for filename in (root_dir / label_dir[dataset_type]).glob('*.txt'):
-            df = pd.read_csv(filename, index_col=None, header=None, names=['dist_img', 'score'])
-            dfs.append(df)
+        return PairIndex.from_paths(os.path.join(root_dir, 'Ref', '') + dist_names.str[:5] + dist_names.str[-4:],
+                                    os.path.join(root_dir, 'Dist', '') + dist_names,
+                                    df['score'],
+                                    categories)
 
-        df = pd.concat(dfs, axis=0, ignore_index=True)
+    def transform(self, ref_img, dist_img):
+        # train mode
+        if self.mode == 'train':
+            return train_transform(ref_img, dist_img, self.img_size, self.device_augment)
+
+        # evaluate mode
+        else:
+            return eval_transform(ref_img, dist_img, self.img_size)
 
-        df['category'] = df['dist_img'].apply(lambda x: dist_type[x[6:8]] + int(x[9:11]))
-        df['ref_img'] = df['dist_img'].apply(lambda x: root_dir / f'Ref/{x[:5] + x[-4:]}')
-        df['dist_img'] = df['dist_img'].apply(lambda x: root_dir / f'Dist/{x}')
 
-        self.origin_scores = df['score'].to_numpy()
-        self.scores = 1 - ((self.origin_scores - np.min(self.origin_scores)) /
-                           (np.max(self.origin_scores) - np.min(self.origin_scores)))
+class PackedDataset(Dataset):
+    """
+    Pairs read from a store written by convert.py, crops are sliced out of the memory map without any image decoding
+    """
 
-        self.categories = df['category'].to_numpy()
+    def __init__(self, packed_dir, split, mode='eval', img_size=(192, 192), device_augment=False):
+        self.images = PackedImages(packed_dir)
 
-        self.df = df[['dist_img', 'ref_img']]
+        with np.load(os.path.join(packed_dir, f'{split}.npz')) as index:
+            self.ref_ids = index['ref']
+            self.dist_ids = index['dist']
+            self.scores = index['score']
+            self.categories = index['category']
+            self.origin_scores = index['origin_score']
 
         self.mode = mode
         self.img_size = img_size
+        self.device_augment = device_augment
+
+    @property
+    def num_images(self):
+        return len(self.images)
+
+    def image_path(self, image_id):
+        return str(self.images.paths[image_id])
+
+    def image(self, image_id):
+        return self.images[image_id]
+
+    def dist_path(self, idx):
+        return str(self.images.paths[self.dist_ids[idx]])
 
     def __len__(self):
-        return len(self.df)
+        return len(self.dist_ids)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        ref_img = Image.open(self.df['ref_img'].iloc[idx]).convert('RGB')
-        dist_img = Image.open(self.df['dist_img'].iloc[idx]).convert('RGB')
+        ref_img = self.images[self.ref_ids[idx]]
+        dist_img = self.images[self.dist_ids[idx]]
 
         ref_img, dist_img = self.transform(ref_img, dist_img)
 
@@ -166,43 +270,248 @@ class PIPAL(Dataset):
     def transform(self, ref_img, dist_img):
         # train mode
         if self.mode == 'train':
-            # Random crop
-            i, j, h, w = transforms.RandomCrop.get_params(ref_img, output_size=self.img_size)
-            ref_img = TF.crop(ref_img, i, j, h, w)
-            dist_img = TF.crop(dist_img, i, j, h, w)
+            return train_transform(ref_img, dist_img, self.img_size, self.device_augment)
 
-            # Random horizontal flipping
-            if random.random() > 0.5:
-                ref_img = TF.hflip(ref_img)
-                dist_img = TF.hflip(dist_img)
+        # evaluate mode
+        else:
+            return eval_transform(ref_img, dist_img, self.img_size)
 
-            rotate_angle = random.choice([0, 90, 180, 270])
-            ref_img = TF.rotate(ref_img, rotate_angle)
-            dist_img = TF.rotate(dist_img, rotate_angle)
 
-            ref_img = TF.to_tensor(ref_img)
-            dist_img = TF.to_tensor(dist_img)
+class ShardedDataset(IterableDataset):
+    """
+    Pairs streamed from the sequential tar shards written by convert.py, in constant memory at any corpus size
 
-            ref_img = TF.normalize(ref_img, [0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-            dist_img = TF.normalize(dist_img, [0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    The shards are split across nodes and DataLoader workers, and training pairs are shuffled through a bounded
+    buffer of ``shuffle_buffer`` pairs.
+    """
 
-            return ref_img, dist_img
+    def __init__(self, shard_dir, split, mode='eval', img_size=(192, 192), device_augment=False, shuffle_buffer=0,
+                 seed=0):
+        with open(os.path.join(shard_dir, f'{split}.json')) as handle:
+            manifest = json.load(handle)
 
-        # evaluate mode
-        else:
-            ref_imgs = TF.five_crop(ref_img, self.img_size)
-            dist_imgs = TF.five_crop(dist_img, self.img_size)
+        self.shards = [os.path.join(shard_dir, shard) for shard in manifest['shards']]
+        self.num_samples = manifest['num_samples']
 
-            ref_imgs = torch.stack([TF.normalize(TF.to_tensor(crop),
-                                                 [0.485, 0.456, 0.406],
-                                                 [0.229, 0.224, 0.225])
-                                    for crop in ref_imgs])
-            dist_imgs = torch.stack([TF.normalize(TF.to_tensor(crop),
-                                                  [0.485, 0.456, 0.406],
-                                                  [0.229, 0.224, 0.225])
-                                     for crop in dist_imgs])
+        self.mode = mode
+        self.img_size = img_size
+        self.device_augment = device_augment
+        self.shuffle_buffer = shuffle_buffer if mode == 'train' else 0
 
-            return ref_imgs, dist_imgs
+        self.seed = seed
+        self.epoch = 0
+        self.num_iterations = 0
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        # Copies in persistent workers never see set_epoch, so each copy also counts its own iterations
+        seed = f'{self.seed}-{self.epoch}-{self.num_iterations}'
+        self.num_iterations += 1
+
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+
+        shards = list(self.shards)
+        if self.shuffle_buffer:
+            # Same shard order on every node and worker, so that their parts do not overlap
+            random.Random(seed).shuffle(shards)
+        shards = shards[rank * num_workers + worker_id::world_size * num_workers]
+
+        rng = random.Random(f'{seed}-{rank}-{worker_id}')
+        buffer = []
+        for shard in shards:
+            for sample in iter_shard(shard):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                if buffer:
+                    idx = rng.randrange(len(buffer))
+                    buffer[idx], sample = sample, buffer[idx]
+                yield self.decode(sample)
+
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self.decode(sample)
+
+    def decode(self, sample):
+        images = {}
+        labels = None
+        for suffix, data in sample.items():
+            if suffix == 'json':
+                labels = json.loads(data)
+            else:
+                images[suffix.split('.')[0]] = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+
+        ref_img, dist_img = self.transform(images['ref'], images['dist'])
+
+        return ref_img, dist_img, labels['score'], labels['category'], labels['origin_score']
+
+    def transform(self, ref_img, dist_img):
+        # train mode
+        if self.mode == 'train':
+            return train_transform(ref_img, dist_img, self.img_size, self.device_augment)
+
+        # evaluate mode
+        else:
+            return eval_transform(ref_img, dist_img, self.img_size)
+
+
+def get_ref_keys(dataset):
+    """
+    Return the id of the reference image of every pair of ``dataset``
+    """
+    if isinstance(dataset, Subset):
+        return get_ref_keys(dataset.dataset)[dataset.indices]
+    return dataset.ref_ids
+
+
+def loader_kwargs(cfg):
+    """
+    Worker and memory options shared by every DataLoader
+    """
+    num_workers = cfg.DATASETS.NUM_WORKERS
+    return {
+        'num_workers': num_workers,
+        'pin_memory': cfg.DATASETS.PIN_MEMORY and torch.cuda.is_available(),
+        'persistent_workers': cfg.DATASETS.PERSISTENT_WORKERS and num_workers > 0
+    }
+
+
+def create_eval_dataloader(cfg, dataset):
+    """
+    DataLoader for evaluation, its batches are grouped by reference image if DATASETS.GROUP_BY_REF is set and the
+    dataset is map-style
+    """
+    if isinstance(dataset, IterableDataset):
+        return DataLoader(dataset, batch_size=cfg.DATASETS.BATCH_SIZE, **loader_kwargs(cfg))
+
+    if cfg.DATASETS.GROUP_BY_REF:
+        return DataLoader(dataset,
+                          batch_sampler=ReferenceBatchSampler(get_ref_keys(dataset), cfg.DATASETS.BATCH_SIZE),
+                          **loader_kwargs(cfg))
+
+    return DataLoader(dataset,
+                      batch_size=cfg.DATASETS.BATCH_SIZE,
+                      shuffle=False,
+                      **loader_kwargs(cfg))
+
+
+def create_feature_dataloader(cfg, dataset, backbone, device):
+    """
+    DataLoader of cached backbone features for evaluating ``dataset`` with a fixed backbone, see FeatureStore
+
+    Returns None when MODEL.BACKBONE.FEATURE_CACHE is unset, the backbone is trained, the dataset is streamed, or there
+    is no backbone (a scorer archive).
+    """
+    base = dataset.dataset if isinstance(dataset, Subset) else dataset
+    if not cfg.MODEL.BACKBONE.FEATURE_CACHE or not cfg.MODEL.BACKBONE.FIXED or isinstance(base, IterableDataset) or \
+            backbone is None:
+        return None
+
+    store = FeatureStore.open(cfg.MODEL.BACKBONE.FEATURE_CACHE,
+                              base,
+                              backbone,
+                              FiveCropPlan(cfg.DATASETS.IMG_SIZE),
+                              dtype=cfg.MODEL.BACKBONE.FEATURE_CACHE_DTYPE,
+                              device=device,
+                              batch_size=cfg.DATASETS.BATCH_SIZE,
+                              # The reference and distorted crops of a training batch per backbone forward
+                              max_crops=2 * cfg.DATASETS.BATCH_SIZE,
+                              num_workers=cfg.DATASETS.NUM_WORKERS)
+
+    return DataLoader(FeatureDataset(store, dataset),
+                      batch_size=cfg.DATASETS.BATCH_SIZE,
+                      shuffle=False,
+                      **loader_kwargs(cfg))
+
+
+def create_grid_feature_dataloader(cfg, dataset, backbone, device):
+    """
+    DataLoader of training pairs as cached backbone features of random crops of TRAIN.FEATURE_GRID, see
+    GridFeatureDataset
+    """
+    plan = GridCropPlan(cfg.DATASETS.IMG_SIZE,
+                        stride=cfg.TRAIN.FEATURE_GRID.STRIDE,
+                        rotations=cfg.TRAIN.FEATURE_GRID.ROTATIONS,
+                        flip=cfg.TRAIN.FEATURE_GRID.FLIP)
+
+    store = FeatureStore.open(cfg.MODEL.BACKBONE.FEATURE_CACHE,
+                              dataset,
+                              backbone,
+                              plan,
+                              dtype=cfg.MODEL.BACKBONE.FEATURE_CACHE_DTYPE,
+                              device=device,
+                              batch_size=cfg.DATASETS.BATCH_SIZE,
+                              # The reference and distorted crops of a training batch per backbone forward
+                              max_crops=2 * cfg.DATASETS.BATCH_SIZE,
+                              num_workers=cfg.DATASETS.NUM_WORKERS)
+
+    return DataLoader(GridFeatureDataset(store, dataset),
+                      batch_size=cfg.DATASETS.BATCH_SIZE,
+                      sampler=ResumableSampler(len(dataset), seed=cfg.TRAIN.SEED),
+                      generator=torch.Generator(),
+                      **loader_kwargs(cfg))
+
+
+def create_dataset(cfg, root_dir, split, mode='eval'):
+    """
+    Create the PIPAL dataset of ``split`` with the backend selected by DATASETS.BACKEND
+    """
+    if cfg.DATASETS.BACKEND == 'shards':
+        return ShardedDataset(shard_dir=Path(root_dir) / SHARDS_DIR,
+                              split=split,
+                              mode=mode,
+                              img_size=cfg.DATASETS.IMG_SIZE,
+                              device_augment=cfg.DATASETS.DEVICE_AUGMENT,
+                              shuffle_buffer=cfg.DATASETS.SHUFFLE_BUFFER)
+
+    if cfg.DATASETS.BACKEND == 'packed':
+        return PackedDataset(packed_dir=Path(root_dir) / PACKED_DIR,
+                             split=split,
+                             mode=mode,
+                             img_size=cfg.DATASETS.IMG_SIZE,
+                             device_augment=cfg.DATASETS.DEVICE_AUGMENT)
+
+    return PIPAL(root_dir=Path(root_dir),
+                 dataset_type=split,
+                 mode=mode,
+                 img_size=cfg.DATASETS.IMG_SIZE,
+                 device_augment=cfg.DATASETS.DEVICE_AUGMENT)
+
+
+def create_eval_dataset(cfg, name):
+    """
+    Create the LIVE or TID2013 dataset with the backend selected by DATASETS.BACKEND
+    """
+    root_dir = DATASET_ROOTS[name]
+
+    if cfg.DATASETS.BACKEND == 'shards':
+        return ShardedDataset(shard_dir=os.path.join(root_dir, SHARDS_DIR),
+                              split='all',
+                              img_size=cfg.DATASETS.IMG_SIZE)
+
+    if cfg.DATASETS.BACKEND == 'packed':
+        return PackedDataset(packed_dir=os.path.join(root_dir, PACKED_DIR),
+                             split='all',
+                             img_size=cfg.DATASETS.IMG_SIZE)
+
+    if name == 'LIVE':
+        dataset = LIVE(root_dir=root_dir, img_size=cfg.DATASETS.IMG_SIZE)
+    else:
+        dataset = TID2013(root_dir=root_dir, img_size=cfg.DATASETS.IMG_SIZE)
+
+    attach_ref_cache([dataset], cfg.DATASETS.REF_CACHE_BYTES)
+
+    return dataset
 
 
 def create_dataloaders(cfg, phase='train'):
@@ -212,15 +521,12 @@ def create_dataloaders(cfg, phase='train'):
     for dataset_type in ['train', 'val', 'test']:
         # training dataset for training phase
         if dataset_type == 'train' and phase == 'train':
-            datasets[dataset_type] = PIPAL(root_dir=Path(cfg.DATASETS.ROOT_DIR),
-                                           dataset_type=dataset_type,
-                                           mode='train',
-                                           img_size=cfg.DATASETS.IMG_SIZE)
+            datasets[dataset_type] = create_dataset(cfg, cfg.DATASETS.ROOT_DIR, dataset_type, mode='train')
         else:
-            datasets[dataset_type] = PIPAL(root_dir=Path(cfg.DATASETS.ROOT_DIR),
-                                           dataset_type=dataset_type,
-                                           mode='eval',
-                                           img_size=cfg.DATASETS.IMG_SIZE)
+            datasets[dataset_type] = create_dataset(cfg, cfg.DATASETS.ROOT_DIR, dataset_type, mode='eval')
+
+    if cfg.DATASETS.BACKEND == 'image':
+        attach_ref_cache(datasets.values(), cfg.DATASETS.REF_CACHE_BYTES)
 
     datasets_size = {x: len(datasets[x]) for x in ['train', 'val', 'test']}
 
@@ -228,14 +534,17 @@ def create_dataloaders(cfg, phase='train'):
     dataloaders = {}
     for dataset_type in ['train', 'val', 'test']:
         if dataset_type == 'train' and phase == 'train':
+            # an IterableDataset shuffles itself
+            sampler = None
+            if not isinstance(datasets[dataset_type], IterableDataset):
+                sampler = ResumableSampler(len(datasets[dataset_type]), seed=cfg.TRAIN.SEED)
+
             dataloaders[dataset_type] = DataLoader(datasets[dataset_type],
                                                    batch_size=cfg.DATASETS.BATCH_SIZE,
-                                                   shuffle=True,
-                                                   num_workers=cfg.DATASETS.NUM_WORKERS)
+                                                   sampler=sampler,
+                                                   generator=torch.Generator(),
+                                                   **loader_kwargs(cfg))
         else:
-            dataloaders[dataset_type] = DataLoader(datasets[dataset_type],
-                                                   batch_size=cfg.DATASETS.BATCH_SIZE,
-                                                   shuffle=False,
-                                                   num_workers=cfg.DATASETS.NUM_WORKERS)
+            dataloaders[dataset_type] = create_eval_dataloader(cfg, datasets[dataset_type])
 
     return dataloaders, datasets_size
@@ -0,0 +1,340 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, Subset
+from tqdm import tqdm
+
+from src.data.transforms import five_crop, normalize, stack_crops
+
+FEATURE_STORE_VERSION = 3
+REFERENCE_STORE_VERSION = 1
+
+
+def weights_fingerprint(module):
+    """
+    Hash of the parameters and buffers of ``module``, what it computes only changes along with it
+    """
+    digest = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class FiveCropPlan:
+    """
+    The five evaluation crops of ``src.data.transforms.five_crop``
+    """
+
+    def __init__(self, img_size):
+        self.img_size = tuple(img_size)
+
+    def key(self):
+        return {'plan': 'five', 'img_size': self.img_size}
+
+    def __call__(self, img):
+        return five_crop(img, self.img_size)
+
+
+class GridCropPlan:
+    """
+    Crops on a grid of positions ``stride`` apart, each optionally flipped and then rotated counterclockwise by k * 90
+    degrees for every k of ``rotations``, as ``src.data.transforms.paired_random_transform`` would
+    """
+
+    def __init__(self, img_size, stride, rotations=(0,), flip=False):
+        self.img_size = tuple(img_size)
+        self.stride = stride
+        self.rotations = tuple(rotations)
+        self.flip = flip
+
+    def key(self):
+        return {'plan': 'grid', 'img_size': self.img_size, 'stride': self.stride, 'rotations': self.rotations,
+                'flip': self.flip}
+
+    def positions(self, length, size):
+        positions = list(range(0, length - size + 1, self.stride))
+        if positions[-1] != length - size:
+            positions.append(length - size)
+        return positions
+
+    def __call__(self, img):
+        th, tw = self.img_size
+        crops = []
+        for i in self.positions(img.shape[0], th):
+            for j in self.positions(img.shape[1], tw):
+                crop = img[i:i + th, j:j + tw]
+                for flipped in ((crop, crop[:, ::-1]) if self.flip else (crop,)):
+                    crops.extend(np.rot90(flipped, k) for k in self.rotations)
+        return crops
+
+
+def pair_image_ids(dataset):
+    """
+    Sorted ids of the images the pairs of an IQADataset/PackedDataset (or a Subset of one) refer to
+
+    A packed dataset holds the images of every split, only the images of its own pairs are worth computing features of.
+    """
+    indices = np.arange(len(dataset))
+    if isinstance(dataset, Subset):
+        indices = np.asarray(dataset.indices)
+        dataset = dataset.dataset
+
+    return np.unique(np.concatenate((np.asarray(dataset.ref_ids)[indices], np.asarray(dataset.dist_ids)[indices])))
+
+
+class _PlanCrops(Dataset):
+    def __init__(self, dataset, image_ids, plan):
+        self.dataset = dataset
+        self.image_ids = image_ids
+        self.plan = plan
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getitem__(self, row):
+        return stack_crops(self.plan(self.dataset.image(int(self.image_ids[row]))))
+
+
+class FeatureStore:
+    """
+    Memory-mapped backbone features of the crops of the images of a dataset
+
+    Level k is stored in level<k>.npy as (num_images, ncrops, C, H, W), whose rows follow the sorted ``image_ids`` the
+    store was built over, see ``rows`` to map image ids of the dataset to them.
+    The store directory is named after a hash of the image paths, the crop plan, the storage dtype and the backbone
+    weights, so a store is never read with features of another configuration.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+        with open(os.path.join(store_dir, 'meta.json')) as handle:
+            meta = json.load(handle)
+        self.paths = meta['paths']
+        self.image_ids = np.asarray(meta['image_ids'])
+        self.num_levels = meta['num_levels']
+        self.num_crops = meta['num_crops']
+
+        self.levels = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['levels'] = None
+        return state
+
+    def open_levels(self):
+        if self.levels is None:
+            self.levels = [np.load(os.path.join(self.store_dir, f'level{k}.npy'), mmap_mode='r')
+                           for k in range(self.num_levels)]
+        return self.levels
+
+    def rows(self, image_ids):
+        """
+        Rows of the store holding the features of the dataset images ``image_ids``
+        """
+        rows = np.searchsorted(self.image_ids, image_ids)
+        assert np.array_equal(self.image_ids[np.minimum(rows, len(self.image_ids) - 1)], image_ids), \
+            'Images without features in the store'
+        return rows
+
+    def __getitem__(self, row):
+        """
+        Features of every crop of an image as a tuple of (ncrops, C, H, W) float tensors, one per level
+        """
+        return tuple(torch.from_numpy(level[row].astype(np.float32)) for level in self.open_levels())
+
+    def crop(self, row, crop):
+        """
+        Features of one crop of an image as a tuple of (C, H, W) float tensors, one per level
+        """
+        return tuple(torch.from_numpy(level[row, crop].astype(np.float32)) for level in self.open_levels())
+
+    @classmethod
+    def open(cls, root_dir, dataset, backbone, plan, dtype='float32', device=torch.device('cpu'), batch_size=4,
+             max_crops=32, num_workers=0):
+        """
+        Open the store of the images of the pairs of ``dataset`` (an IQADataset/PackedDataset or a Subset of one)
+        under ``root_dir``, computing it first if it does not exist yet
+
+        The crops of ``batch_size`` images are read at a time, and go through the backbone ``max_crops`` at a time.
+        """
+        image_ids = pair_image_ids(dataset)
+        if isinstance(dataset, Subset):
+            dataset = dataset.dataset
+
+        paths = [dataset.image_path(image_id) for image_id in image_ids.tolist()]
+        key = hashlib.sha1(json.dumps({
+            'version': FEATURE_STORE_VERSION,
+            'paths': paths,
+            'plan': plan.key(),
+            'dtype': dtype,
+            'backbone': weights_fingerprint(backbone)
+        }).encode()).hexdigest()
+        store_dir = os.path.join(root_dir, key[:16])
+
+        if not os.path.isfile(os.path.join(store_dir, 'meta.json')):
+            cls.build(store_dir, paths, image_ids, dataset, backbone, plan, dtype, device, batch_size, max_crops,
+                      num_workers)
+
+        return cls(store_dir)
+
+    @staticmethod
+    def check_disk_space(store_dir, shapes, dtype):
+        """
+        Report the size of level files of ``shapes``, and fail before allocating them if the disk cannot hold them
+        """
+        num_bytes = sum(int(np.prod(shape)) for shape in shapes) * np.dtype(dtype).itemsize
+        free_bytes = shutil.disk_usage(store_dir).free
+        print(f'Backbone features: {num_bytes / 2 ** 30:.2f} GiB in {store_dir}, {free_bytes / 2 ** 30:.2f} GiB free')
+
+        if num_bytes > free_bytes:
+            raise OSError(f'Not enough disk space for the backbone features in {store_dir}: {num_bytes} bytes needed, '
+                          f'{free_bytes} free')
+
+    @staticmethod
+    def build(store_dir, paths, image_ids, dataset, backbone, plan, dtype, device, batch_size, max_crops,
+              num_workers):
+        tmp_dir = store_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        dataloader = DataLoader(_PlanCrops(dataset, image_ids, plan), batch_size=batch_size, num_workers=num_workers)
+
+        training = backbone.training
+        backbone.eval()
+
+        levels = None
+        row = 0
+        with torch.no_grad():
+            for crops in tqdm(dataloader, desc='Backbone features'):
+                bs, ncrops, c, h, w = crops.size()
+                # Peak memory follows max_crops rather than the number of crops of the plan
+                chunks = [backbone(normalize(chunk.to(device)))
+                          for chunk in crops.view(-1, c, h, w).split(max_crops)]
+                feats = [torch.cat(level) for level in zip(*chunks)]
+
+                if levels is None:
+                    shapes = [(len(paths), ncrops) + feat.shape[1:] for feat in feats]
+                    FeatureStore.check_disk_space(tmp_dir, shapes, dtype)
+                    levels = [np.lib.format.open_memmap(os.path.join(tmp_dir, f'level{k}.npy'), mode='w+',
+                                                        dtype=dtype, shape=shape)
+                              for k, shape in enumerate(shapes)]
+
+                for level, feat in zip(levels, feats):
+                    level[row:row + bs] = feat.reshape(bs, ncrops, *feat.shape[1:]).cpu().numpy()
+                row += bs
+
+        backbone.train(training)
+
+        for level in levels:
+            level.flush()
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as handle:
+            json.dump({'paths': paths, 'image_ids': image_ids.tolist(), 'num_levels': len(levels),
+                       'num_crops': levels[0].shape[1]}, handle)
+
+        shutil.rmtree(store_dir, ignore_errors=True)
+        os.replace(tmp_dir, store_dir)
+
+
+class ReferenceStore:
+    """
+    Prepared references of a MultiTask in eval mode (see MultiTask.prepare_reference), one .pt file per reference image
+    holding the prepared tensors of all its evaluation crops
+
+    The files are named after a hash of the reference path and the crop size, in a directory named after the weights of
+    the backbone and the evaluator and the precision they run in, so a reference is never reused with another model.
+    """
+
+    def __init__(self, root_dir, netD, img_size, precision):
+        key = hashlib.sha1(json.dumps({
+            'version': REFERENCE_STORE_VERSION,
+            'backbone': weights_fingerprint(netD.backbone),
+            'evaluator': weights_fingerprint(netD.evaluator),
+            'precision': precision
+        }).encode()).hexdigest()
+        self.store_dir = os.path.join(root_dir, key[:16])
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        self.img_size = tuple(img_size)
+        # The batches of one reference follow one another, its last prepared reference is kept in memory
+        self.last = None
+
+    def file(self, ref_path):
+        key = hashlib.sha1(json.dumps({'path': str(ref_path), 'img_size': self.img_size}).encode()).hexdigest()
+        return os.path.join(self.store_dir, f'{key}.pt')
+
+    def get(self, ref_path, prepare, device=torch.device('cpu')):
+        """
+        The prepared reference of the image at ``ref_path``, computed by ``prepare()`` and saved the first time
+        """
+        if self.last is not None and self.last[0] == ref_path:
+            return self.last[1]
+
+        file = self.file(ref_path)
+        if os.path.isfile(file):
+            prepared = torch.load(file, map_location=device)
+        else:
+            prepared = prepare()
+            torch.save(prepared, file + '.tmp')
+            os.replace(file + '.tmp', file)
+
+        self.last = (ref_path, prepared)
+        return prepared
+
+
+class FeatureDataset(Dataset):
+    """
+    The pairs of an IQADataset/PackedDataset (or a Subset of one) with cached backbone features in place of images
+
+    The image ids of the pairs are kept as rows of ``store``.
+    """
+
+    def __init__(self, store, dataset):
+        indices = np.arange(len(dataset))
+        if isinstance(dataset, Subset):
+            indices = np.asarray(dataset.indices)
+            dataset = dataset.dataset
+
+        self.store = store
+        self.ref_ids = store.rows(np.asarray(dataset.ref_ids)[indices])
+        self.dist_ids = store.rows(np.asarray(dataset.dist_ids)[indices])
+        self.scores = np.asarray(dataset.scores)[indices]
+        self.categories = np.asarray(dataset.categories)[indices]
+        self.origin_scores = np.asarray(dataset.origin_scores)[indices]
+
+    def __len__(self):
+        return len(self.dist_ids)
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        return self.store[self.ref_ids[idx]], self.store[self.dist_ids[idx]], \
+               self.scores[idx], self.categories[idx], self.origin_scores[idx]
+
+
+class GridFeatureDataset(FeatureDataset):
+    """
+    Training pairs as the cached features of one random crop of a GridCropPlan, the same for both images of a pair
+    """
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        crop = random.randrange(self.store.num_crops)
+        return self.store.crop(self.ref_ids[idx], crop), self.store.crop(self.dist_ids[idx], crop), \
+               self.scores[idx], self.categories[idx], self.origin_scores[idx]
+
+
+def is_feature_loader(dataloader):
+    """
+    Whether the batches of ``dataloader`` hold cached backbone features instead of images
+    """
+    return isinstance(dataloader.dataset, FeatureDataset)
@@ -0,0 +1,95 @@
+import hashlib
+import os
+
+import numpy as np
+
+INDEX_CACHE_DIR = '.index_cache'
+
+
+class PairIndex:
+    """
+    Columnar index of (reference, distorted) image pairs
+
+    Every column is a contiguous NumPy array and the paths are interned into one string table (a single uint8 buffer
+    plus offsets), so the index holds no per-pair Python objects. Forked DataLoader workers therefore share it
+    copy-on-write instead of each touching, and so copying, every row.
+    """
+
+    def __init__(self, path_data, path_offsets, ref_ids, dist_ids, origin_scores, categories):
+        self.path_data = path_data
+        self.path_offsets = path_offsets
+        self.ref_ids = ref_ids
+        self.dist_ids = dist_ids
+        self.origin_scores = origin_scores
+        self.categories = categories
+
+    @classmethod
+    def from_paths(cls, ref_paths, dist_paths, origin_scores, categories=None):
+        ref_paths = np.asarray(ref_paths, dtype=str)
+        dist_paths = np.asarray(dist_paths, dtype=str)
+
+        paths, inverse = np.unique(np.concatenate([ref_paths, dist_paths]), return_inverse=True)
+        encoded = [path.encode() for path in paths.tolist()]
+
+        path_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(path) for path in encoded], out=path_offsets[1:])
+
+        if categories is None:
+            categories = np.zeros(len(dist_paths), dtype=np.int64)
+
+        return cls(path_data=np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                   path_offsets=path_offsets,
+                   ref_ids=inverse[:len(ref_paths)].astype(np.int32),
+                   dist_ids=inverse[len(ref_paths):].astype(np.int32),
+                   origin_scores=np.asarray(origin_scores, dtype=np.float64),
+                   categories=np.asarray(categories, dtype=np.int64))
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as data:
+            return cls(**{key: data[key] for key in data.files})
+
+    def save(self, file):
+        np.savez(file, **self.__dict__)
+
+    def __len__(self):
+        return len(self.dist_ids)
+
+    @property
+    def num_paths(self):
+        return len(self.path_offsets) - 1
+
+    def path(self, path_id):
+        return self.path_data[self.path_offsets[path_id]:self.path_offsets[path_id + 1]].tobytes().decode()
+
+    def ref_path(self, idx):
+        return self.path(self.ref_ids[idx])
+
+    def dist_path(self, idx):
+        return self.path(self.dist_ids[idx])
+
+
+def cached_index(root_dir, name, label_files, build):
+    """
+    Return the PairIndex made by ``build``, cached under <root_dir>/.index_cache and keyed by the label files' mtimes
+    """
+    label_files = sorted(str(label_file) for label_file in label_files)
+    key = hashlib.sha1(repr([str(root_dir), name] +
+                            [(label_file, os.stat(label_file).st_mtime_ns) for label_file in label_files]).encode())
+    cache_path = os.path.join(root_dir, INDEX_CACHE_DIR, f'{name}-{key.hexdigest()[:16]}.npz')
+
+    if os.path.isfile(cache_path):
+        return PairIndex.load(cache_path)
+
+    index = build()
+
+    # The cache is only an optimization, a read-only dataset directory simply rebuilds the index every time
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + '.tmp', 'wb') as handle:
+            index.save(handle)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError:
+        pass
+
+    return index
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+PACKED_DIR = 'packed'
+
+
+def pack_datasets(datasets, output_dir):
+    """
+    Decode every image of ``datasets`` (a dict of split name to IQADataset) once into a packed uint8 store
+
+    The store is made of
+        images.bin: every image as raw uint8 HWC bytes, back to back
+        images.npz: byte offset, shape and path of every image
+        <split>.npz: ref/dist image indices, scores, categories and original scores (DMOS/MOS) of each pair
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    image_ids = {}
+    splits = {}
+    for split, dataset in datasets.items():
+        index = dataset.index
+
+        # Map the path ids of each split onto one global image id
+        path_ids = np.array([image_ids.setdefault(index.path(path_id), len(image_ids))
+                             for path_id in range(index.num_paths)], dtype=np.int32)
+
+        splits[split] = {
+            'ref': path_ids[index.ref_ids],
+            'dist': path_ids[index.dist_ids],
+            'score': np.asarray(dataset.scores, dtype=np.float64),
+            'category': index.categories,
+            'origin_score': index.origin_scores
+        }
+
+    offsets = np.zeros(len(image_ids), dtype=np.int64)
+    shapes = np.zeros((len(image_ids), 2), dtype=np.int32)
+
+    offset = 0
+    with open(os.path.join(output_dir, 'images.bin'), 'wb') as handle:
+        for idx, path in enumerate(tqdm(image_ids)):
+            img = np.asarray(Image.open(path).convert('RGB'), dtype=np.uint8)
+            handle.write(img.tobytes())
+
+            offsets[idx] = offset
+            shapes[idx] = img.shape[:2]
+            offset += img.nbytes
+
+    np.savez(os.path.join(output_dir, 'images.npz'), offsets=offsets, shapes=shapes, paths=np.array(list(image_ids)))
+    for split, index in splits.items():
+        np.savez(os.path.join(output_dir, f'{split}.npz'), **index)
+
+
+class PackedImages:
+    """
+    Read-only view of images.bin/images.npz, the memory map is opened lazily so that it is not pickled into workers
+    """
+
+    def __init__(self, packed_dir):
+        self.path = os.path.join(packed_dir, 'images.bin')
+
+        with np.load(os.path.join(packed_dir, 'images.npz')) as meta:
+            self.offsets = meta['offsets']
+            self.shapes = meta['shapes']
+            self.paths = meta['paths']
+
+        self.buffer = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['buffer'] = None
+        return state
+
+    def __getitem__(self, idx):
+        if self.buffer is None:
+            self.buffer = np.memmap(self.path, dtype=np.uint8, mode='r')
+
+        h, w = map(int, self.shapes[idx])
+        offset = int(self.offsets[idx])
+        return self.buffer[offset:offset + h * w * 3].reshape(h, w, 3)
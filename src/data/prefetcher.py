@@ -0,0 +1,80 @@
+import torch
+
+
+def to_channels_last(tensor):
+    """
+    channels_last layout for (N, C, H, W) batches and for (N, ncrops, C, H, W) crop batches, the latter staying
+    channels_last once viewed as (N * ncrops, C, H, W)
+    """
+    if tensor.dim() == 4:
+        return tensor.contiguous(memory_format=torch.channels_last)
+    if tensor.dim() == 5:
+        return tensor.permute(0, 1, 3, 4, 2).contiguous().permute(0, 1, 4, 2, 3)
+    return tensor
+
+
+class DevicePrefetcher:
+    """
+    Wrap a DataLoader so that every batch arrives on ``device``
+
+    On CUDA the next batch is copied from pinned memory on a side stream while the current step runs, so compute does
+    not wait on the input path. On CPU the batches are passed through.
+    """
+
+    def __init__(self, dataloader, device, channels_last=False):
+        self.dataloader = dataloader
+        self.device = device
+        self.channels_last = channels_last
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    @property
+    def batch_sampler(self):
+        return self.dataloader.batch_sampler
+
+    def to_device(self, batch):
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self.to_device(item) for item in batch)
+        if not torch.is_tensor(batch):
+            return batch
+
+        batch = batch.to(self.device, non_blocking=True)
+        return to_channels_last(batch) if self.channels_last else batch
+
+    def record_stream(self, batch, stream):
+        if isinstance(batch, (list, tuple)):
+            for item in batch:
+                self.record_stream(item, stream)
+        elif torch.is_tensor(batch):
+            batch.record_stream(stream)
+
+    def preload(self, batches):
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(self.stream):
+            return self.to_device(batch)
+
+    def __iter__(self):
+        batches = iter(self.dataloader)
+
+        if self.stream is None:
+            for batch in batches:
+                yield self.to_device(batch)
+            return
+
+        next_batch = self.preload(batches)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+
+            batch = next_batch
+            # The memory was allocated on the side stream but is consumed on the current one
+            self.record_stream(batch, current_stream)
+
+            next_batch = self.preload(batches)
+            yield batch
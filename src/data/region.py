@@ -0,0 +1,100 @@
+import os
+import struct
+
+import numpy as np
+from PIL import Image
+
+BMP_EXTENSIONS = ('.bmp',)
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+
+class BMPImage:
+    """
+    Uncompressed 24/32-bit BMP file whose regions are sliced out of a memory map
+
+    Behaves as a read-only uint8 HWC array for ``shape``, 2D slicing and ``np.asarray``, so the crop functions of
+    ``src.data.transforms`` only read the rows and columns of the crops they take.
+    """
+
+    def __init__(self, path, offset, height, width, channels, stride, bottom_up):
+        self.path = path
+        self.offset = offset
+        self.height = height
+        self.width = width
+        self.channels = channels
+        self.stride = stride
+        self.bottom_up = bottom_up
+
+    @property
+    def shape(self):
+        return self.height, self.width, 3
+
+    def __array__(self, dtype=None, copy=None):
+        img = self.read(0, self.height, 0, self.width)
+        return img if dtype is None else img.astype(dtype)
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        if not isinstance(rows, slice) or not isinstance(cols, slice) or rows.step not in (None, 1) \
+                or cols.step not in (None, 1):
+            return np.asarray(self)[key]
+
+        top, bottom, _ = rows.indices(self.height)
+        left, right, _ = cols.indices(self.width)
+        return self.read(top, max(bottom, top), left, max(right, left))
+
+    def read(self, top, bottom, left, right):
+        data = np.memmap(self.path, dtype=np.uint8, mode='r', offset=self.offset, shape=(self.height, self.stride))
+
+        # Bottom-up files store the last image row first
+        if self.bottom_up:
+            block = data[self.height - bottom:self.height - top][::-1]
+        else:
+            block = data[top:bottom]
+
+        # BGR(X) to RGB, copied so that the memory map is released
+        block = block[:, left * self.channels:right * self.channels].reshape(bottom - top, right - left, self.channels)
+        return np.ascontiguousarray(block[..., 2::-1])
+
+
+def open_bmp(path):
+    """
+    A BMPImage for the uncompressed 24/32-bit BMP at ``path``, or None when its layout cannot be memory mapped
+    """
+    with open(path, 'rb') as handle:
+        header = handle.read(34)
+
+    if len(header) < 34 or header[:2] != b'BM':
+        return None
+
+    offset, dib_size, width, height, _, bits, compression = struct.unpack('<10xIIiiHHI', header)
+    if dib_size < 40 or compression != 0 or bits not in (24, 32) or width <= 0 or height == 0:
+        return None
+
+    channels = bits // 8
+    stride = (width * bits + 31) // 32 * 4
+    if os.path.getsize(path) < offset + stride * abs(height):
+        return None
+
+    return BMPImage(path, offset, abs(height), width, channels, stride, bottom_up=height > 0)
+
+
+def open_image(path):
+    """
+    Open an image as an uint8 HWC array-like, reading only the regions that are sliced when the format allows it
+
+    Uncompressed BMP files are memory mapped. PIL cannot decode a region of a JPEG and its reduced-size draft decoding
+    would lower the resolution of the crops, so JPEG files are only decoded straight into RGB by the codec. Any other
+    file is fully decoded.
+    """
+    ext = os.path.splitext(str(path))[1].lower()
+
+    if ext in BMP_EXTENSIONS:
+        img = open_bmp(path)
+        if img is not None:
+            return img
+
+    img = Image.open(path)
+    if ext in JPEG_EXTENSIONS:
+        img.draft('RGB', img.size)
+    return np.asarray(img.convert('RGB'))
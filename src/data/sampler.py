@@ -0,0 +1,81 @@
+import math
+
+import torch
+from torch.utils.data import Sampler
+
+
+class ReferenceBatchSampler(Sampler):
+    """
+    Batch sampler whose batches only hold pairs sharing one reference image
+
+    Combined with ``MultiTask.forward_shared_reference`` the reference of a batch goes through the backbone once.
+    """
+
+    def __init__(self, ref_keys, batch_size, shuffle=False):
+        super(ReferenceBatchSampler, self).__init__(None)
+
+        groups = {}
+        for idx, key in enumerate(ref_keys.tolist()):
+            groups.setdefault(key, []).append(idx)
+
+        self.groups = list(groups.values())
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        batches = [group[i:i + self.batch_size]
+                   for group in self.groups
+                   for i in range(0, len(group), self.batch_size)]
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+        return iter(batches)
+
+    def __len__(self):
+        return sum(math.ceil(len(group) / self.batch_size) for group in self.groups)
+
+
+def shares_reference(dataloader):
+    """
+    Whether every batch of ``dataloader`` holds pairs of a single reference image
+    """
+    return isinstance(dataloader.batch_sampler, ReferenceBatchSampler)
+
+
+class ResumableSampler(Sampler):
+    """
+    Shuffling sampler whose order only depends on ``seed`` and the epoch, so that an epoch can be resumed part way
+
+    A ``start`` loaded with ``load_state_dict`` makes the next iteration skip the samples already consumed in that
+    epoch. Workers prefetch ahead of the training loop, so the consumed count comes from the loop, not the sampler.
+    """
+
+    def __init__(self, num_samples, seed=0):
+        super(ResumableSampler, self).__init__(None)
+
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'start': self.start}
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict['epoch']
+        self.start = state_dict['start']
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.num_samples, generator=generator).tolist()
+
+        start, self.start = self.start, 0
+        return iter(order[start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
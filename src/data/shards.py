@@ -0,0 +1,81 @@
+import io
+import json
+import os
+import tarfile
+
+import numpy as np
+from tqdm import tqdm
+
+SHARDS_DIR = 'shards'
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shards(datasets, output_dir, shard_size=1000, orders=None):
+    """
+    Write ``datasets`` (a dict of split name to IQADataset) as sequential tar shards
+
+    Every pair is stored as three consecutive members sharing a key: <key>.ref.<ext> and <key>.dist.<ext> hold the
+    original image files and <key>.json holds the score, category and original score. The shards of a split are
+    listed with its number of pairs in <split>.json. ``orders`` optionally gives the order in which the pairs of each
+    split are written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    for split, dataset in datasets.items():
+        index = dataset.index
+        order = orders[split] if orders and split in orders else np.arange(len(index))
+
+        shards = []
+        tar = None
+        for position, idx in enumerate(tqdm(order, desc=split)):
+            if position % shard_size == 0:
+                if tar is not None:
+                    tar.close()
+                shards.append(f'{split}-{len(shards):06d}.tar')
+                tar = tarfile.open(os.path.join(output_dir, shards[-1]), 'w')
+
+            key = f'{position:09d}'
+            for role, path in (('ref', index.ref_path(idx)), ('dist', index.dist_path(idx))):
+                with open(path, 'rb') as handle:
+                    _add_member(tar, f'{key}.{role}{os.path.splitext(path)[1].lower()}', handle.read())
+
+            labels = {
+                'score': float(dataset.scores[idx]),
+                'category': int(index.categories[idx]),
+                'origin_score': float(index.origin_scores[idx])
+            }
+            _add_member(tar, f'{key}.json', json.dumps(labels).encode())
+
+        if tar is not None:
+            tar.close()
+
+        with open(os.path.join(output_dir, f'{split}.json'), 'w') as handle:
+            json.dump({'num_samples': len(order), 'shards': shards}, handle)
+
+
+def iter_shard(path):
+    """
+    Stream the samples of one shard as dicts of suffix to member bytes, reading the file sequentially
+    """
+    sample = {}
+    current_key = None
+
+    with tarfile.open(path, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            key, suffix = member.name.split('.', 1)
+            if key != current_key and sample:
+                yield sample
+                sample = {}
+            current_key = key
+            sample[suffix] = tar.extractfile(member).read()
+
+    if sample:
+        yield sample
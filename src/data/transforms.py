@@ -0,0 +1,122 @@
+import random
+
+import numpy as np
+import torch
+import torchvision.transforms.functional as TF
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+def to_tensor(img):
+    """
+    Convert an uint8 HWC array into a normalized float CHW tensor
+    """
+    img = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1).float().div(255)
+    return TF.normalize(img, IMAGENET_MEAN, IMAGENET_STD)
+
+
+def to_uint8_tensor(img):
+    """
+    Convert an uint8 HWC array into an uint8 CHW tensor
+    """
+    return torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)
+
+
+def stack_crops(crops):
+    """
+    Stack uint8 HWC crops into one uint8 (N, C, H, W) tensor, normalization is left to ``normalize`` on the device
+    """
+    return torch.from_numpy(np.stack(crops)).permute(0, 3, 1, 2)
+
+
+def normalize(imgs):
+    """
+    Convert an uint8 (..., C, H, W) batch into normalized float, in one batched op on the device of ``imgs``
+    """
+    mean = torch.tensor(IMAGENET_MEAN, device=imgs.device).view(-1, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=imgs.device).view(-1, 1, 1)
+    return imgs.float().div_(255).sub_(mean).div_(std)
+
+
+def random_crop_params(height, width, size):
+    """
+    Same sampling as ``transforms.RandomCrop.get_params``
+    """
+    th, tw = size
+    i = torch.randint(0, height - th + 1, size=(1,)).item()
+    j = torch.randint(0, width - tw + 1, size=(1,)).item()
+    return i, j
+
+
+def five_crop(img, size):
+    """
+    Same crops and order as ``TF.five_crop`` for an HWC array, the crops are views of ``img``
+    """
+    h, w = img.shape[:2]
+    th, tw = size
+    top = int(round((h - th) / 2.0))
+    left = int(round((w - tw) / 2.0))
+
+    return [img[:th, :tw],
+            img[:th, w - tw:],
+            img[h - th:, :tw],
+            img[h - th:, w - tw:],
+            img[top:top + th, left:left + tw]]
+
+
+def paired_random_transform(ref_img, dist_img, size):
+    """
+    Random crop, horizontal flipping and rotation shared by a pair of HWC arrays
+    """
+    i, j = random_crop_params(ref_img.shape[0], ref_img.shape[1], size)
+    ref_img = ref_img[i:i + size[0], j:j + size[1]]
+    dist_img = dist_img[i:i + size[0], j:j + size[1]]
+
+    if random.random() > 0.5:
+        ref_img = ref_img[:, ::-1]
+        dist_img = dist_img[:, ::-1]
+
+    # Counterclockwise, as TF.rotate on a square crop
+    k = random.choice([0, 90, 180, 270]) // 90
+    ref_img = np.rot90(ref_img, k)
+    dist_img = np.rot90(dist_img, k)
+
+    return ref_img, dist_img
+
+
+def paired_random_augment(ref_imgs, dist_imgs, size):
+    """
+    Batched ``paired_random_transform`` of uint8 (N, C, H, W) batches on their own device
+
+    Every pair draws its own crop, horizontal flipping and rotation, shared by its reference and distorted images. The
+    three are folded into one gather per batch, and the crops are returned normalized.
+    """
+    assert size[0] == size[1], 'rotations need square crops'
+
+    n, _, h, w = ref_imgs.shape
+    s = size[0]
+    device = ref_imgs.device
+
+    i = torch.randint(0, h - s + 1, (n, 1, 1), device=device)
+    j = torch.randint(0, w - s + 1, (n, 1, 1), device=device)
+    flip = torch.rand((n, 1, 1), device=device) > 0.5
+    k = torch.randint(0, 4, (n,), device=device)
+
+    # Source (row, column) in the crop of each output pixel after a counterclockwise rotation of k * 90 degrees
+    y = torch.arange(s, device=device).view(-1, 1).expand(s, s)
+    x = torch.arange(s, device=device).view(1, -1).expand(s, s)
+    rows = torch.stack([y, x, s - 1 - y, s - 1 - x])[k]
+    cols = torch.stack([x, s - 1 - y, s - 1 - x, y])[k]
+
+    # The flip happens before the rotation
+    cols = torch.where(flip, s - 1 - cols, cols)
+
+    rows = rows + i
+    cols = cols + j
+    batch = torch.arange(n, device=device).view(-1, 1, 1)
+
+    ref_imgs = ref_imgs.permute(0, 2, 3, 1)[batch, rows, cols].permute(0, 3, 1, 2)
+    dist_imgs = dist_imgs.permute(0, 2, 3, 1)[batch, rows, cols].permute(0, 3, 1, 2)
+
+    return normalize(ref_imgs), normalize(dist_imgs)
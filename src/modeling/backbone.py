@@ -1,3 +1,6 @@
+import abc
+from contextlib import contextmanager
+
 import numpy as np
 import timm
 import torch
@@ -6,7 +9,57 @@ from torch import nn as nn
 from torchvision import models
 
 
-class Backbone(nn.Module):
+def conv_output_size(size, kernel_size, stride=1, padding=0):
+    return (size + 2 * padding - kernel_size) // stride + 1
+
+
+class SplitBatchNorm2d(nn.BatchNorm2d):
+    """
+    BatchNorm2d that, in train mode, normalizes the parts of the batch given by ``split_sizes`` one after another
+
+    A fused forward over several inputs concatenated along the batch then keeps the batch statistics and running
+    statistics updates of separate forwards.
+    """
+
+    split_sizes = None
+
+    def forward(self, x):
+        if not self.training or self.split_sizes is None:
+            return super(SplitBatchNorm2d, self).forward(x)
+        return torch.cat([super(SplitBatchNorm2d, self).forward(part) for part in x.split(self.split_sizes)])
+
+
+def use_split_batchnorm(module):
+    """
+    Turn the BatchNorm2d layers of ``module`` into SplitBatchNorm2d in place, keeping their parameters and buffers
+
+    Returns False if ``module`` holds other batch normalization layers, which would mix the parts of a fused batch.
+    """
+    convertible = True
+    for submodule in module.modules():
+        if type(submodule) is nn.BatchNorm2d:
+            submodule.__class__ = SplitBatchNorm2d
+        elif isinstance(submodule, nn.modules.batchnorm._BatchNorm) and not isinstance(submodule, SplitBatchNorm2d):
+            convertible = False
+    return convertible
+
+
+@contextmanager
+def split_batchnorm(module, split_sizes):
+    """
+    Make the SplitBatchNorm2d layers of ``module`` normalize the parts of the batch given by ``split_sizes`` separately
+    """
+    layers = [submodule for submodule in module.modules() if isinstance(submodule, SplitBatchNorm2d)]
+    for layer in layers:
+        layer.split_sizes = split_sizes
+    try:
+        yield
+    finally:
+        for layer in layers:
+            layer.split_sizes = None
+
+
+class Backbone(nn.Module, metaclass=abc.ABCMeta):
     def __init__(self):
         super(Backbone, self).__init__()
         self.slices = nn.ModuleList([])
@@ -19,12 +72,33 @@ class Backbone(nn.Module):
 
         return tuple(feats)
 
+    @abc.abstractmethod
+    def output_shapes(self, img_size):
+        """
+        (C, H, W) of every output for an input of ``img_size``, computed without running the backbone
+        """
+        return NotImplemented
+
 
 class InceptionResNetV2Backbone(Backbone):
-    def __init__(self, level='low'):
+    # Stage (block whose output size it keeps) at which every slice of each level ends
+    LEVEL_STAGES = {
+        'low': ('mixed_5b',) * 6,
+        'medium': ('mixed_6a',) * 6,
+        'high': ('mixed_7a',) * 6,
+        'mixed': ('mixed_5b',) * 6 + ('mixed_6a',) * 6 + ('mixed_7a',) * 6,
+        'reduced mixed': ('mixed_5b',) * 3 + ('mixed_6a',) * 3 + ('mixed_7a',) * 3
+    }
+    STAGE_CHANNELS = {'mixed_5b': 320, 'mixed_6a': 1088, 'mixed_7a': 2080}
+    # Source of the pretrained weights, referenced by compact weight files, see src.tool.weights
+    pretrained_name = 'timm/inception_resnet_v2'
+
+    def __init__(self, level='low', pretrained=True):
         super(InceptionResNetV2Backbone, self).__init__()
 
-        inception_resnet_v2_pretrained = timm.create_model('inception_resnet_v2', pretrained=True)
+        self.level = level
+
+        inception_resnet_v2_pretrained = timm.create_model('inception_resnet_v2', pretrained=pretrained)
         inception_resnet_v2_pretrained_features = list(inception_resnet_v2_pretrained.children())
 
         if level == 'low':  # low level feature extraction backbone
@@ -73,8 +147,27 @@ class InceptionResNetV2Backbone(Backbone):
             self.slices.append(nn.Sequential(*inception_resnet_v2_pretrained_features[12][5:],
                                              inception_resnet_v2_pretrained_features[13]))
 
+    def output_shapes(self, img_size):
+        stage_sizes = {}
+        for size in img_size:
+            size = conv_output_size(size, 3, stride=2)  # conv2d_1a
+            size = conv_output_size(size, 3)  # conv2d_2a, conv2d_2b keeps the size
+            size = conv_output_size(size, 3, stride=2)  # maxpool_3a, conv2d_3b keeps the size
+            size = conv_output_size(size, 3)  # conv2d_4a
+            size = conv_output_size(size, 3, stride=2)  # maxpool_5a, mixed_5b and Block35 keep the size
+            stage_sizes.setdefault('mixed_5b', []).append(size)
+            size = conv_output_size(size, 3, stride=2)  # mixed_6a, Block17 keeps the size
+            stage_sizes.setdefault('mixed_6a', []).append(size)
+            size = conv_output_size(size, 3, stride=2)  # mixed_7a, Block8 keeps the size
+            stage_sizes.setdefault('mixed_7a', []).append(size)
+
+        return tuple((self.STAGE_CHANNELS[stage],) + tuple(stage_sizes[stage])
+                     for stage in self.LEVEL_STAGES[self.level])
+
 
 class VGG16Backbone(Backbone):
+    pretrained_name = 'torchvision/vgg16'
+
     def __init__(self, pretrained=True):
         super().__init__()
         vgg_pretrained_features = models.vgg16(pretrained=pretrained).features
@@ -112,6 +205,18 @@ class VGG16Backbone(Backbone):
         feats = super(VGG16Backbone, self).forward(x)
         return tuple([x]) + feats
 
+    def output_shapes(self, img_size):
+        h, w = img_size
+        shapes = [(3, h, w), (64, h, w)]
+
+        # Every L2pooling halves the size, the 3x3 convolutions are padded
+        for channels in (128, 256, 512, 512):
+            h = conv_output_size(h, 3, stride=2, padding=1)
+            w = conv_output_size(w, 3, stride=2, padding=1)
+            shapes.append((channels, h, w))
+
+        return tuple(shapes)
+
 
 class L2pooling(nn.Module):
     def __init__(self, filter_size=5, stride=2, channels=None):
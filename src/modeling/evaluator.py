@@ -4,6 +4,8 @@ import torch
 from torch import nn as nn
 
 from src.modeling.feature_projection import IQTFeatureProjection, SeparateFeatureProjection, MixedFeatureProjection
+from src.modeling.precision import float32
+from src.modeling.token_reduction import build_token_reduction
 from src.modeling.transformer import Transformer, MLPHead
 
 
@@ -15,6 +17,25 @@ class Evaluator(nn.Module, metaclass=abc.ABCMeta):
     def forward(self, feats1, feats2):
         return NotImplemented
 
+    def prepare_reference(self, feats1):
+        """
+        The part of forward that only depends on the reference features, computed once and reused for every
+        distorted image compared with the same reference, see forward_prepared
+        """
+        return feats1
+
+    def forward_prepared(self, prepared, feats2):
+        """
+        Same as forward against a prepared reference
+
+        The batch of feats2 holds the distorted images one block after another, every block lines up with the batch
+        the reference was prepared from (e.g. the crops of one reference image).
+        """
+        num_repeats = feats2[0].size(0) // prepared[0].size(0)
+        if num_repeats > 1:
+            prepared = tuple(feat.repeat(num_repeats, 1, 1, 1) for feat in prepared)
+        return self.forward(prepared, feats2)
+
 
 class DISTS(Evaluator):
     def __init__(self, backbone_channels):
@@ -29,34 +50,55 @@ class DISTS(Evaluator):
         self.beta = nn.Parameter(beta)
 
     def forward(self, feats1, feats2):
-        dist1 = 0
-        dist2 = 0
+        return self.forward_prepared(self.prepare_reference(feats1), feats2)
+
+    def prepare_reference(self, feats1):
+        """
+        Per level, the (n, C) channel means and variances of the reference features, and the features themselves for
+        the cross-covariance with the distorted ones
+        """
+        prepared = []
+        with float32(feats1[0].device.type):
+            for feat in feats1:
+                feat = feat.float()
+                x_var, x_mean = torch.var_mean(feat, [2, 3], unbiased=False)
+                prepared.append((x_mean, x_var, feat))
+        return tuple(prepared)
+
+    def forward_prepared(self, prepared, feats2):
+        # The statistics stay in float32 under autocast, c1 and c2 are below the resolution of float16/bfloat16
+        with float32(feats2[0].device.type):
+            return self.similarity(prepared, tuple(feat.float() for feat in feats2))
+
+    def similarity(self, prepared, feats2):
         c1 = 1e-6
         c2 = 1e-6
 
-        alpha = self.alpha.sigmoid()
-        beta = self.beta.sigmoid()
-        w_sum = alpha.sum() + beta.sum()
-        alpha = torch.split(alpha / w_sum, self.channels, dim=1)
-        beta = torch.split(beta / w_sum, self.channels, dim=1)
+        s1 = []
+        s2 = []
+        for k, (x_mean, x_var, x_feat) in enumerate(prepared):
+            # (num_repeats, n, C, H, W), the n reference crops broadcast over the distorted images
+            n, c, h, w = x_feat.shape
+            y_feat = feats2[k].reshape(-1, n, c, h, w)
+
+            # Both moments of the distorted features in one reduction, and the cross term in one more, against the
+            # reference features, without feature-sized temporaries
+            y_var, y_mean = torch.var_mean(y_feat, [3, 4], unbiased=False)
+            xy_cov = torch.einsum('rnchw,nchw->rnc', y_feat, x_feat) / (h * w) - x_mean * y_mean
 
-        for k in range(len(self.channels)):
-            x_mean = feats1[k].mean([2, 3], keepdim=True)
-            y_mean = feats2[k].mean([2, 3], keepdim=True)
-            s1 = (2 * x_mean * y_mean + c1) / (x_mean ** 2 + y_mean ** 2 + c1)
-            dist1 = dist1 + (alpha[k] * s1).sum(1, keepdim=True)
+            s1.append(((2 * x_mean * y_mean + c1) / (x_mean ** 2 + y_mean ** 2 + c1)).flatten(0, 1))
+            s2.append(((2 * xy_cov + c2) / (x_var + y_var + c2)).flatten(0, 1))
 
-            x_var = ((feats1[k] - x_mean) ** 2).mean([2, 3], keepdim=True)
-            y_var = ((feats2[k] - y_mean) ** 2).mean([2, 3], keepdim=True)
-            xy_cov = (feats1[k] * feats2[k]).mean([2, 3], keepdim=True) - x_mean * y_mean
-            s2 = (2 * xy_cov + c2) / (x_var + y_var + c2)
-            dist2 = dist2 + (beta[k] * s2).sum(1, keepdim=True)
+        # The channel-weighted sums of every level as one matrix-vector product, alpha and beta follow the channels of
+        # the levels in order
+        weights = torch.cat((self.alpha, self.beta), 1).view(-1).sigmoid()
+        dist = torch.cat(s1 + s2, 1) @ (weights / weights.sum())
 
-        return 1 - torch.squeeze(dist1 + dist2)
+        return 1 - torch.squeeze(dist)
 
 
 class TransformerEvaluator(Evaluator):
-    def __init__(self, cfg, backbone_channels, backbone_output_size):
+    def __init__(self, cfg, backbone_channels, backbone_output_size, backbone_spatial_shapes):
         super(TransformerEvaluator, self).__init__()
 
         self.feat_proj = SeparateFeatureProjection(
@@ -74,18 +116,52 @@ class TransformerEvaluator(Evaluator):
         )
         self.mlp_head = MLPHead(in_dim=cfg.MODEL.TRANSFORMER.TRANSFORMER_DIM, hidden_dim=cfg.MODEL.TRANSFORMER.HEAD_DIM)
 
+        # Every level is projected to its own tokens
+        self.token_reduction = build_token_reduction(cfg, cfg.MODEL.TRANSFORMER.TRANSFORMER_DIM,
+                                                     backbone_spatial_shapes)
+
     def forward(self, ref_feat, dist_feat):
-        diff_feat = tuple(map(lambda i, j: i - j, ref_feat, dist_feat))
+        return self.forward_prepared(self.prepare_reference(ref_feat), dist_feat)
+
+    def prepare_reference(self, feats1):
+        """
+        The (n, L, C) projected reference tokens, before embedding, and, in eval mode with a token reduction that does
+        not depend on the distorted image, the first decoder self-attention over the embedded and reduced ones
+        """
+        ref_tokens = self.feat_proj.forward_feat(feats1)
+        if self.training or not self.token_reduction.static:
+            return ref_tokens, None
+
+        target = self.transformer.prepare_target(self.token_reduction.reduce(self.feat_proj.embed(ref_tokens)))
+        return ref_tokens, target
 
-        ref_proj_feat = self.feat_proj(ref_feat)
-        diff_proj_feat = self.feat_proj(diff_feat)
+    def forward_prepared(self, prepared, feats2):
+        ref_tokens, target = prepared
 
-        return self.mlp_head(self.transformer(diff_proj_feat, ref_proj_feat)[0])
+        # The distorted images follow one another, each lined up with the n reference crops, which broadcast over them
+        n, length, d = ref_tokens.shape
+        dist_tokens = self.feat_proj.forward_feat(feats2, bias=False)
+        num_repeats = dist_tokens.size(0) // n
+
+        # Same as the tokens of the feature differences, the projection is linear up to its bias
+        diff_tokens = (ref_tokens - dist_tokens.view(num_repeats, n, length, d)).flatten(0, 1)
+        diff_proj_feat = self.feat_proj.embed(diff_tokens)
+
+        if target is None:
+            # The decoder self-attends over the reference tokens of every distorted image here, a view when there is
+            # one distorted image per reference
+            ref_proj_feat = self.feat_proj.embed(ref_tokens).expand(num_repeats, -1, -1, -1).flatten(0, 1)
+            diff_proj_feat, ref_proj_feat = self.token_reduction(diff_proj_feat, ref_proj_feat, diff_tokens)
+            return self.mlp_head(self.transformer(diff_proj_feat, ref_proj_feat)[:, 0])
+
+        # The n prepared targets are shared by the distorted images in the decoder
+        diff_proj_feat = self.token_reduction.reduce(diff_proj_feat)
+        return self.mlp_head(self.transformer(diff_proj_feat, target, prepared_tgt=True)[:, 0])
 
 
 class IQT(TransformerEvaluator):
-    def __init__(self, cfg, backbone_channels, backbone_output_size):
-        super(IQT, self).__init__(cfg, backbone_channels, backbone_output_size)
+    def __init__(self, cfg, backbone_channels, backbone_output_size, backbone_spatial_shapes):
+        super(IQT, self).__init__(cfg, backbone_channels, backbone_output_size, backbone_spatial_shapes)
         assert cfg.MODEL.BACKBONE.NAME == 'InceptionResNetV2'
         assert cfg.MODEL.BACKBONE.FEAT_LEVEL in ['low', 'medium', 'high', 'mixed']
 
@@ -103,3 +179,10 @@ class IQT(TransformerEvaluator):
                 input_dim=sum(backbone_channels),
                 hidden_dim=cfg.MODEL.TRANSFORMER.TRANSFORMER_DIM
             )
+
+        # The levels of the same size are projected to the same tokens
+        if cfg.MODEL.BACKBONE.FEAT_LEVEL == 'mixed':
+            token_shapes = (backbone_spatial_shapes[0], backbone_spatial_shapes[6], backbone_spatial_shapes[12])
+        else:
+            token_shapes = backbone_spatial_shapes[:1]
+        self.token_reduction = build_token_reduction(cfg, cfg.MODEL.TRANSFORMER.TRANSFORMER_DIM, token_shapes)
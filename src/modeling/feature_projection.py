@@ -1,7 +1,24 @@
 import torch
+import torch.nn.functional as F
 from torch import nn as nn
 
 
+def project_levels(feats, conv, bias=True):
+    """
+    The 1x1 ``conv`` of the channel concatenation of ``feats``, flattened to (N, C, H * W)
+
+    It is computed as the sum of the 1x1 convolutions of every level by its slice of the weight, which is the same
+    without materializing the concatenation. ``bias=False`` leaves out the bias of ``conv``.
+    """
+    weights = conv.weight.split([feat.size(1) for feat in feats], 1)
+
+    projection = F.conv2d(feats[0], weights[0], conv.bias if bias else None)
+    for feat, weight in zip(feats[1:], weights[1:]):
+        projection += F.conv2d(feat, weight)
+
+    return projection.flatten(2)
+
+
 class FeatureProjection(nn.Module):
     """
     A base class for feature projection
@@ -13,18 +30,18 @@ class FeatureProjection(nn.Module):
         self.quality_embed = nn.Embedding(1, hidden_dim)
         self.position_embed = nn.Embedding(num_pos + 1, hidden_dim)
 
-    def forward_feat(self, feats) -> torch.Tensor:
+    def forward_feat(self, feats, bias=True) -> torch.Tensor:
         pass
 
-    def forward(self, feats):
-        batch_size = feats[0].shape[0]
-
-        extra_quality_embedding = self.quality_embed.weight.unsqueeze(0).repeat(batch_size, 1, 1)
-        quality_embedding = torch.cat((extra_quality_embedding, self.forward_feat(feats)), 1)
+    def embed(self, tokens):
+        """
+        Prepend the quality token to (N, L, C) tokens and add the position embedding, both broadcast over the batch
+        """
+        extra_quality_embedding = self.quality_embed.weight.expand(tokens.size(0), 1, -1)
+        return torch.cat((extra_quality_embedding, tokens), 1) + self.position_embed.weight
 
-        position_embedding = self.position_embed.weight.unsqueeze(0).repeat(batch_size, 1, 1)
-
-        return quality_embedding + position_embedding
+    def forward(self, feats):
+        return self.embed(self.forward_feat(feats))
 
 
 class IQTFeatureProjection(FeatureProjection):
@@ -40,9 +57,8 @@ class IQTFeatureProjection(FeatureProjection):
             nn.Flatten(start_dim=2, end_dim=-1)
         )
 
-    def forward_feat(self, feats):
-        feat = torch.cat(feats, 1)
-        return self.flatten_conv2d(feat).permute(0, 2, 1)
+    def forward_feat(self, feats, bias=True):
+        return project_levels(feats, self.flatten_conv2d[0], bias).permute(0, 2, 1)
 
 
 class MixedFeatureProjection(FeatureProjection):
@@ -66,10 +82,10 @@ class MixedFeatureProjection(FeatureProjection):
             nn.Flatten(start_dim=2, end_dim=-1)
         )
 
-    def forward_feat(self, feats) -> torch.Tensor:
-        low_level_embed = self.low_level_flatten_conv2d(torch.cat(feats[:6], 1))
-        medium_level_embed = self.medium_level_flatten_conv2d(torch.cat(feats[6:12], 1))
-        high_level_embed = self.high_level_flatten_conv2d(torch.cat(feats[12:], 1))
+    def forward_feat(self, feats, bias=True) -> torch.Tensor:
+        low_level_embed = project_levels(feats[:6], self.low_level_flatten_conv2d[0], bias)
+        medium_level_embed = project_levels(feats[6:12], self.medium_level_flatten_conv2d[0], bias)
+        high_level_embed = project_levels(feats[12:], self.high_level_flatten_conv2d[0], bias)
 
         return torch.cat((low_level_embed, medium_level_embed, high_level_embed), 2).permute(0, 2, 1)
 
@@ -85,9 +101,9 @@ class SeparateFeatureProjection(FeatureProjection):
         self.parts = nn.ModuleList([nn.Sequential(nn.Conv2d(input_dim, hidden_dim, 1),
                                                   nn.Flatten(start_dim=2, end_dim=-1)) for input_dim in input_dims])
 
-    def forward_feat(self, feats) -> torch.Tensor:
+    def forward_feat(self, feats, bias=True) -> torch.Tensor:
         projections = []
         for feat, part in zip(feats, self.parts):
-            projections.append(part(feat))
+            projections.append(project_levels((feat,), part[0], bias))
 
         return torch.cat(projections, 2).permute(0, 2, 1)
@@ -1,14 +1,16 @@
 import torch
 import torch.nn as nn
 
-from src.modeling.backbone import InceptionResNetV2Backbone, VGG16Backbone
+from src.modeling.backbone import InceptionResNetV2Backbone, VGG16Backbone, split_batchnorm, use_split_batchnorm
 from src.modeling.evaluator import IQT, DISTS, TransformerEvaluator
+from src.modeling.precision import autocast_forward
 
 
 class Generator(nn.Module):
-    def __init__(self, img_shape=(3, 192, 192), latent_dim=100):
+    def __init__(self, img_shape=(3, 192, 192), latent_dim=100, precision='fp32'):
         super().__init__()
 
+        self.precision = precision
         img_channels, self.img_height, self.img_wide = img_shape
 
         self.latent_encode = nn.Linear(latent_dim, self.img_height * self.img_wide)
@@ -29,6 +31,7 @@ class Generator(nn.Module):
             nn.Upsample(scale_factor=2), nn.Conv2d(128, img_channels, (3, 3), stride=(1, 1), padding=1)
         )
 
+    @autocast_forward
     def forward(self, img, noise, quality, distort):
         noise = self.latent_encode(noise).view(noise.size(0), 1, self.img_height, self.img_wide)
         quality = self.quality_encode(quality).view(quality.size(0), 1, self.img_height, self.img_wide)
@@ -44,7 +47,7 @@ class Generator(nn.Module):
         u3 = self.up3(u2, d2)
         u4 = self.up4(u3, d1)
 
-        return self.final(u4)
+        return self.final(u4).float()
 
 
 class UNetDown(nn.Module):
@@ -110,43 +113,119 @@ class Classifier(nn.Module):
 
 
 class MultiTask(nn.Module):
-    def __init__(self, cfg):
+    def __init__(self, cfg, pretrained=True):
+        """
+        ``pretrained=False`` skips fetching the pretrained backbone weights, for a model whose whole state_dict is
+        loaded right after
+        """
         super().__init__()
 
         if cfg.MODEL.BACKBONE.NAME == 'VGG16':
-            self.backbone = VGG16Backbone()
+            self.backbone = VGG16Backbone(pretrained=pretrained)
         else:
-            self.backbone = InceptionResNetV2Backbone(level=cfg.MODEL.BACKBONE.FEAT_LEVEL)
+            self.backbone = InceptionResNetV2Backbone(level=cfg.MODEL.BACKBONE.FEAT_LEVEL, pretrained=pretrained)
 
         # Calculate backbone output channels and feature map size
-        sample_input = torch.randn((1, 3, cfg.DATASETS.IMG_SIZE[0], cfg.DATASETS.IMG_SIZE[1]))
-        sample_output = self.backbone(sample_input)
         backbone_channels = []
         backbone_output_size = []
+        backbone_spatial_shapes = []
 
-        for output in sample_output:
-            backbone_channels.append(output.shape[1])
-            backbone_output_size.append(output.shape[2] * output.shape[3])
+        for channels, height, width in self.backbone.output_shapes(cfg.DATASETS.IMG_SIZE):
+            backbone_channels.append(channels)
+            backbone_output_size.append(height * width)
+            backbone_spatial_shapes.append((height, width))
 
         backbone_channels = tuple(backbone_channels)
         backbone_output_size = tuple(backbone_output_size)
+        backbone_spatial_shapes = tuple(backbone_spatial_shapes)
 
         if cfg.MODEL.BACKBONE.FIXED:
             for parameter in self.backbone.parameters():
                 parameter.requires_grad = False
 
+        # Autocast precision of the forward methods, their outputs are float32 whatever it is
+        self.precision = cfg.MODEL.PRECISION
+
+        # The reference and distorted images go through the backbone in one pass, see backbone_pair
+        self.fused = cfg.MODEL.BACKBONE.FUSED
+        self.split_bn = use_split_batchnorm(self.backbone)
+
         self.discriminator = Discriminator(input_dim=backbone_channels[-1])
         self.classifier = Classifier(input_dim=backbone_channels[-1])
 
         if cfg.MODEL.EVALUATOR == 'IQT':
-            self.evaluator = IQT(cfg, backbone_channels, backbone_output_size)
+            self.evaluator = IQT(cfg, backbone_channels, backbone_output_size, backbone_spatial_shapes)
         elif cfg.MODEL.EVALUATOR == 'DISTS':
             self.evaluator = DISTS(backbone_channels)
         else:
-            self.evaluator = TransformerEvaluator(cfg, backbone_channels, backbone_output_size)
-
-    def forward(self, ref_img, dist_img):
-        ref_feat = self.backbone(ref_img)
+            self.evaluator = TransformerEvaluator(cfg, backbone_channels, backbone_output_size, backbone_spatial_shapes)
+
+    def backbone_pair(self, ref_img, dist_img):
+        """
+        Backbone features of ref_img and of dist_img
+
+        When fused, both batches are concatenated into one backbone pass and the features of every level are split
+        afterwards. In train mode, the BatchNorm layers still normalize each batch on its own, see SplitBatchNorm2d.
+        """
+        if not self.fused or ref_img.shape[1:] != dist_img.shape[1:] or (self.training and not self.split_bn):
+            return self.backbone(ref_img), self.backbone(dist_img)
+
+        split_sizes = [ref_img.size(0), dist_img.size(0)]
+        with split_batchnorm(self.backbone, split_sizes):
+            feats = self.backbone(torch.cat((ref_img, dist_img)))
+
+        feats = [feat.split(split_sizes) for feat in feats]
+        return tuple(ref_feat for ref_feat, _ in feats), tuple(dist_feat for _, dist_feat in feats)
+
+    @autocast_forward
+    def forward(self, ref_img, dist_img, heads=True):
+        """
+        Validity, categories and quality scores of the distorted images
+
+        ``heads=False`` is the inference mode, it skips the discriminator and classifier heads and returns None in
+        place of their outputs, the scores are the same.
+        """
+        return self.forward_features(*self.backbone_pair(ref_img, dist_img), heads=heads)
+
+    @autocast_forward
+    def forward_features(self, ref_feat, dist_feat, heads=True):
+        """
+        Same as forward on backbone features that were already computed, e.g. read from a FeatureStore
+        """
+        return self.forward_heads(dist_feat, self.evaluator(ref_feat, dist_feat), heads)
+
+    def forward_heads(self, dist_feat, scores, heads=True):
+        if not heads:
+            return None, None, scores.float()
+        return self.discriminator(dist_feat[-1]).view(-1).float(), self.classifier(dist_feat[-1]).float(), \
+            scores.float()
+
+    @autocast_forward
+    def prepare_reference(self, ref_img):
+        """
+        Reference-only part of the evaluator for the crops in ref_img, see Evaluator.prepare_reference
+
+        The result is a nested tuple of tensors, which can be kept (or saved, see ReferenceStore) and passed to
+        forward_prepared for every distorted image of the same reference.
+        """
+        return self.evaluator.prepare_reference(self.backbone(ref_img))
+
+    @autocast_forward
+    def forward_prepared(self, prepared, dist_img, heads=True):
+        """
+        Same as forward_shared_reference against a prepared reference
+        """
         dist_feat = self.backbone(dist_img)
-        return self.discriminator(dist_feat[-1]).view(-1), self.classifier(dist_feat[-1]), self.evaluator(ref_feat,
-                                                                                                          dist_feat)
+        return self.forward_heads(dist_feat, self.evaluator.forward_prepared(prepared, dist_feat), heads)
+
+    @autocast_forward
+    def forward_shared_reference(self, ref_img, dist_img, heads=True):
+        """
+        Same as forward for pairs sharing one reference image
+
+        ref_img holds the n crops of the reference once, and dist_img holds the same n crops of every distorted
+        image one after another, so the reference goes through the backbone only once.
+        """
+        ref_feat, dist_feat = self.backbone_pair(ref_img, dist_img)
+        prepared = self.evaluator.prepare_reference(ref_feat)
+        return self.forward_heads(dist_feat, self.evaluator.forward_prepared(prepared, dist_feat), heads)
@@ -0,0 +1,55 @@
+import contextlib
+import functools
+
+import torch
+
+# Autocast dtype of every MODEL.PRECISION, None keeps everything in float32
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+# Largest PLCC or SRCC difference to float32 a reduced MODEL.PRECISION is accepted with, see eval.py --check_precision
+PRECISION_TOLERANCE = 0.002
+
+
+def autocast_dtype(precision, device):
+    """
+    dtype autocast runs in for ``precision`` on ``device``, None for float32
+
+    CPU autocast only supports bfloat16, so 'fp16' also runs in bfloat16 there.
+    """
+    dtype = PRECISIONS[precision]
+    if dtype is not None and device.type != 'cuda':
+        return torch.bfloat16
+    return dtype
+
+
+def autocast(precision, device):
+    dtype = autocast_dtype(precision, device)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, dtype=dtype)
+
+
+def autocast_forward(method):
+    """
+    Run a method of a module with a ``precision`` attribute under autocast, on the device of its parameters
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with autocast(self.precision, next(self.parameters()).device):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def float32(device_type):
+    """
+    Turn autocast off for a float32 island, the tensors going in have to be cast with .float()
+    """
+    return torch.autocast(device_type, enabled=False)
+
+
+def grad_scaler(precision, device):
+    """
+    GradScaler of the optimizers, only enabled for float16, whose range would flush small gradients to zero
+    """
+    return torch.cuda.amp.GradScaler(enabled=autocast_dtype(precision, device) == torch.float16)
@@ -0,0 +1,111 @@
+import torch
+import torch.nn.functional as F
+from torch import nn as nn
+
+
+class TokenReduction(nn.Module):
+    """
+    A base class for token reduction, which keeps every token
+
+    A token reduction shortens the (N, 1 + L, D) difference and reference token sequences of a feature projection
+    before the transformer. The quality token stays first, and the remaining tokens of both sequences are reduced in
+    the same way, so that they keep referring to the same image positions. ``diff_features`` are the (N, L, D)
+    difference tokens before the quality token and the position embedding are added.
+    """
+
+    # Whether every sequence is reduced on its own by reduce, so the reduced reference tokens do not depend on the
+    # distorted image
+    static = True
+
+    def reduce(self, tokens):
+        return tokens
+
+    def forward(self, diff_tokens, ref_tokens, diff_features):
+        return self.reduce(diff_tokens), self.reduce(ref_tokens)
+
+
+class SpatialPooling(TokenReduction):
+    """
+    Average pooling of the tokens of every group (a level, or levels of the same size projected together) over
+    ``kernel_size`` x ``kernel_size`` windows of their (h, w) grid
+
+    The 1x1 convolutions of the projections commute with the pooling, so this is the same as projecting pooled
+    features, and it has no parameters of its own.
+    """
+
+    def __init__(self, token_shapes, kernel_size=2):
+        super(SpatialPooling, self).__init__()
+        self.token_shapes = tuple(token_shapes)
+        self.kernel_size = kernel_size
+
+    def reduce(self, tokens):
+        n, _, d = tokens.shape
+
+        pooled = [tokens[:, :1]]
+        start = 1
+        for h, w in self.token_shapes:
+            grid = tokens[:, start:start + h * w].transpose(1, 2).reshape(n, d, h, w)
+            pooled.append(F.avg_pool2d(grid, self.kernel_size, ceil_mode=True).flatten(2).transpose(1, 2))
+            start += h * w
+
+        return torch.cat(pooled, 1)
+
+
+class TokenMerging(TokenReduction):
+    """
+    Learned merging of the tokens into ``num_tokens`` weighted averages, whose weights come from the difference tokens
+    """
+
+    static = False
+
+    def __init__(self, dim, num_tokens):
+        super(TokenMerging, self).__init__()
+        self.assign = nn.Linear(dim, num_tokens)
+
+    def forward(self, diff_tokens, ref_tokens, diff_features):
+        # (N, num_tokens, L), every merged token averages all the tokens
+        weights = self.assign(diff_tokens[:, 1:]).transpose(1, 2).softmax(-1)
+
+        return torch.cat((diff_tokens[:, :1], weights @ diff_tokens[:, 1:]), 1), \
+            torch.cat((ref_tokens[:, :1], weights @ ref_tokens[:, 1:]), 1)
+
+
+class TopKPruning(TokenReduction):
+    """
+    Keep the ``num_tokens`` positions whose difference features have the largest norm, in their original order
+
+    The ranking is on the features before the position embedding, so that it only reflects how much the distorted
+    image differs from the reference.
+    """
+
+    static = False
+
+    def __init__(self, num_tokens):
+        super(TopKPruning, self).__init__()
+        self.num_tokens = num_tokens
+
+    def forward(self, diff_tokens, ref_tokens, diff_features):
+        n, length, d = diff_tokens.shape
+        num_tokens = min(self.num_tokens, length - 1)
+
+        index = diff_features.norm(dim=-1).topk(num_tokens, dim=1).indices.sort(dim=1).values + 1
+        index = torch.cat((index.new_zeros(n, 1), index), 1)[..., None].expand(-1, -1, d)
+
+        return diff_tokens.gather(1, index), ref_tokens.gather(1, index)
+
+
+def build_token_reduction(cfg, dim, token_shapes):
+    """
+    The MODEL.TRANSFORMER.TOKEN_REDUCTION of an evaluator whose projection yields tokens of the (h, w) groups in
+    ``token_shapes``
+    """
+    reduction = cfg.MODEL.TRANSFORMER.TOKEN_REDUCTION
+
+    if reduction.METHOD == 'pool':
+        return SpatialPooling(token_shapes, reduction.POOL_SIZE)
+    elif reduction.METHOD == 'merge':
+        return TokenMerging(dim, reduction.NUM_TOKENS)
+    elif reduction.METHOD == 'topk':
+        return TopKPruning(reduction.NUM_TOKENS)
+    else:
+        return TokenReduction()
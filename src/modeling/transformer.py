@@ -1,7 +1,12 @@
 import copy
+import math
 
+import torch
+import torch.nn.functional as F
 from torch import nn as nn
 
+from src.modeling.precision import float32
+
 
 class Transformer(nn.Module):
     def __init__(self,
@@ -19,12 +24,99 @@ class Transformer(nn.Module):
         decoder_layer = TransformerDecoderLayer(d_model, nhead, dim_feedforward, dropout)
         self.decoder = TransformerDecoder(decoder_layer, num_decoder_layers)
 
-    def forward(self, src, tgt):
-        memory = self.encoder(src.permute(1, 0, 2))
-        output = self.decoder(tgt.permute(1, 0, 2), memory)
+    def forward(self, src, tgt, prepared_tgt=False):
+        """
+        Batch-first (N, L, E) src and tgt, the output is batch-first too
+
+        With ``prepared_tgt``, tgt is the output of prepare_target rather than the target itself, and may hold n
+        targets shared by r * n sources, the r groups of n sources following one another.
+        """
+        memory = self.encoder(src)
+        output = self.decoder(tgt, memory, prepared_tgt)
 
         return output
 
+    def prepare_target(self, tgt):
+        """
+        The part of the decoder that only depends on tgt, the self-attention of its first layer
+        """
+        return self.decoder.layers[0].self_attend(tgt)
+
+
+class MultiheadAttention(nn.Module):
+    """
+    Batch-first multi-head attention on scaled_dot_product_attention, where PyTorch provides it
+
+    The parameters are named and laid out as those of nn.MultiheadAttention (in_proj_weight holds the query, key and
+    value projections stacked), so its state_dict loads unchanged. Self-attention projects the query, key and value in
+    one matmul. A query batch of n against a key and value batch of r * n attends every one of the r groups of n keys
+    with the same n queries, which are not repeated.
+    """
+
+    def __init__(self, embed_dim, num_heads, dropout=0.):
+        super(MultiheadAttention, self).__init__()
+        assert embed_dim % num_heads == 0, 'embed_dim must be divisible by num_heads'
+
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.dropout = dropout
+
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Same initialization as nn.MultiheadAttention
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.constant_(self.in_proj_bias, 0.)
+        nn.init.constant_(self.out_proj.bias, 0.)
+
+    def split_heads(self, x):
+        # (N, L, E) -> (N, num_heads, L, head_dim)
+        return x.view(x.size(0), x.size(1), self.num_heads, -1).transpose(1, 2)
+
+    def forward(self, query, key, value):
+        if query is key and key is value:
+            q, k, v = F.linear(query, self.in_proj_weight, self.in_proj_bias).chunk(3, -1)
+        else:
+            w_q, w_k, w_v = self.in_proj_weight.chunk(3)
+            b_q, b_k, b_v = self.in_proj_bias.chunk(3)
+            q = F.linear(query, w_q, b_q)
+            if key is value:
+                k, v = F.linear(key, torch.cat((w_k, w_v)), torch.cat((b_k, b_v))).chunk(2, -1)
+            else:
+                k, v = F.linear(key, w_k, b_k), F.linear(value, w_v, b_v)
+
+        q, k, v = self.split_heads(q), self.split_heads(k), self.split_heads(v)
+        dropout = self.dropout if self.training else 0.
+
+        groups = key.size(0) // query.size(0)
+        if groups > 1:
+            # (r, n, num_heads, S, head_dim) keys and values, the queries broadcast over the r groups
+            k, v = k.view(groups, -1, *k.shape[1:]), v.view(groups, -1, *v.shape[1:])
+
+        if groups == 1 and hasattr(F, 'scaled_dot_product_attention'):
+            # Picks a fused (flash or memory-efficient) kernel where one applies
+            output = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout)
+        else:
+            attention = torch.softmax(q @ k.transpose(-2, -1) / math.sqrt(q.size(-1)), dim=-1)
+            output = F.dropout(attention, p=dropout) @ v
+
+        output = output.transpose(-3, -2).reshape(key.size(0), query.size(1), self.embed_dim)
+        return self.out_proj(output)
+
+
+class LayerNorm(nn.LayerNorm):
+    """
+    LayerNorm computed in float32 under autocast
+    """
+
+    def forward(self, x):
+        with float32(x.device.type):
+            return super(LayerNorm, self).forward(x.float()).type_as(x)
+
 
 class TransformerEncoder(nn.Module):
     def __init__(self, encoder_layer, num_layers):
@@ -44,20 +136,20 @@ class TransformerEncoder(nn.Module):
 class TransformerEncoderLayer(nn.Module):
     def __init__(self, d_model, nhead, dim_feedforward=1024, dropout=0.1):
         super().__init__()
-        self.multihead_self_attention = nn.MultiheadAttention(d_model, nhead)
+        self.multihead_self_attention = MultiheadAttention(d_model, nhead)
 
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
         self.linear2 = nn.Linear(dim_feedforward, d_model)
 
-        self.norm1 = nn.LayerNorm(d_model)
-        self.norm2 = nn.LayerNorm(d_model)
+        self.norm1 = LayerNorm(d_model)
+        self.norm2 = LayerNorm(d_model)
 
         self.activation = nn.ReLU()
 
     def forward(self, src):
-        src2 = self.multihead_self_attention(query=src, key=src, value=src)[0]
+        src2 = self.multihead_self_attention(query=src, key=src, value=src)
         src = self.norm1(src + src2)
         src2 = self.linear2(self.dropout(self.activation(self.linear1(src))))
         src = self.norm2(src + src2)
@@ -71,11 +163,14 @@ class TransformerDecoder(nn.Module):
         self.layers = _get_clones(decoder_layer, num_layers)
         self.num_layers = num_layers
 
-    def forward(self, tgt, memory):
+    def forward(self, tgt, memory, prepared_tgt=False):
         output = tgt
 
-        for layer in self.layers:
-            output = layer(output, memory)
+        for i, layer in enumerate(self.layers):
+            if i == 0 and prepared_tgt:
+                output = layer.attend_memory(output, memory)
+            else:
+                output = layer(output, memory)
 
         return output
 
@@ -84,26 +179,31 @@ class TransformerDecoderLayer(nn.Module):
     def __init__(self, d_model, nhead, dim_feedforward=1024, dropout=0.1):
         super().__init__()
 
-        self.multihead_self_attention = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
-        self.multihead_attention = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.multihead_self_attention = MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.multihead_attention = MultiheadAttention(d_model, nhead, dropout=dropout)
 
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
         self.linear2 = nn.Linear(dim_feedforward, d_model)
 
-        self.norm1 = nn.LayerNorm(d_model)
-        self.norm2 = nn.LayerNorm(d_model)
-        self.norm3 = nn.LayerNorm(d_model)
+        self.norm1 = LayerNorm(d_model)
+        self.norm2 = LayerNorm(d_model)
+        self.norm3 = LayerNorm(d_model)
 
         self.activation = nn.ReLU()
 
     def forward(self, tgt, memory):
-        tgt2 = self.multihead_self_attention(query=tgt, key=tgt, value=tgt)[0]
-        tgt = self.norm1(tgt + tgt2)
+        return self.attend_memory(self.self_attend(tgt), memory)
+
+    def self_attend(self, tgt):
+        tgt2 = self.multihead_self_attention(query=tgt, key=tgt, value=tgt)
+        return self.norm1(tgt + tgt2)
 
-        tgt2 = self.multihead_attention(query=tgt, key=memory, value=memory)[0]
-        tgt = self.norm2(tgt + tgt2)
+    def attend_memory(self, tgt, memory):
+        # tgt may be shared by groups of the memory batch, see MultiheadAttention
+        tgt2 = self.multihead_attention(query=tgt, key=memory, value=memory)
+        tgt = self.norm2((tgt2.view(-1, *tgt.shape) + tgt).flatten(0, 1))
 
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt))))
         tgt = self.norm3(tgt + tgt2)
@@ -0,0 +1,37 @@
+import os
+import random
+
+import numpy as np
+import torch
+
+CHECKPOINT_NAME = 'checkpoint.pth'
+
+
+def get_rng_states():
+    """
+    States of the Python, NumPy, torch and CUDA random number generators of this process
+    """
+    states = {
+        'random': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['random'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def save_checkpoint(state, path):
+    """
+    Write ``state`` to ``path`` atomically, a job preempted while saving keeps its previous checkpoint
+    """
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
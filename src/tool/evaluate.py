@@ -5,6 +5,11 @@ import torch
 from scipy.stats import spearmanr, kendalltau, pearsonr
 from tqdm import tqdm
 
+from src.data.features import is_feature_loader
+from src.data.prefetcher import DevicePrefetcher
+from src.data.sampler import shares_reference
+from src.data.transforms import normalize
+
 warnings.simplefilter('ignore', np.RankWarning)
 
 
@@ -17,39 +22,85 @@ def calculate_correlation_coefficient(gt_qual, pred_qual):
            np.abs(kendalltau(gt_qual, pred_qual)[0])
 
 
-def evaluate(dataloader, netD, device=torch.device('cpu')):
+def average_crops(outputs, bs, ncrops):
+    return tuple(output.view(bs, ncrops, -1).mean(1) if output is not None else None for output in outputs)
+
+
+def forward_cached_features(netD, ref_feats, dist_feats, heads=True):
+    """
+    netD outputs averaged over the crops of cached (bs, ncrops, C, H, W) backbone features, see FeatureStore
+    """
+    bs, ncrops = dist_feats[0].shape[:2]
+    outputs = netD.forward_features(tuple(feat.flatten(0, 1) for feat in ref_feats),
+                                    tuple(feat.flatten(0, 1) for feat in dist_feats), heads=heads)
+    return average_crops(outputs, bs, ncrops)
+
+
+def forward_eval_batch(netD, ref_imgs, dist_imgs, shared_ref=False, cached=False, heads=True):
+    """
+    netD outputs averaged over the crops of an evaluation batch of uint8 (bs, ncrops, c, h, w) crops, or of cached
+    backbone features when ``cached``
+
+    With ``heads=False`` only the scores are computed, see MultiTask.forward.
+    """
+    if cached:
+        return forward_cached_features(netD, ref_imgs, dist_imgs, heads)
+
+    ref_imgs = normalize(ref_imgs)
+    dist_imgs = normalize(dist_imgs)
+
+    # Format batch
+    bs, ncrops, c, h, w = ref_imgs.size()
+
+    if shared_ref:
+        outputs = netD.forward_shared_reference(ref_imgs[0], dist_imgs.view(-1, c, h, w), heads=heads)
+    else:
+        outputs = netD(ref_imgs.view(-1, c, h, w), dist_imgs.view(-1, c, h, w), heads=heads)
+    return average_crops(outputs, bs, ncrops)
+
+
+def forward_prepared_batch(netD, prepared, dist_imgs, heads=True):
+    """
+    netD outputs averaged over the crops of uint8 (bs, ncrops, c, h, w) distorted crops of one reference, against the
+    prepared crops of that reference, see MultiTask.prepare_reference
+    """
+    dist_imgs = normalize(dist_imgs)
+    bs, ncrops, c, h, w = dist_imgs.size()
+
+    return average_crops(netD.forward_prepared(prepared, dist_imgs.view(-1, c, h, w), heads=heads), bs, ncrops)
+
+
+def evaluate(dataloader, netD, device=torch.device('cpu'), channels_last=False):
     record = {
         'gt_scores': [],
         'pred_scores': [],
     }
     result = {}
 
+    shared_ref = shares_reference(dataloader)
+    cached = is_feature_loader(dataloader)
+
     netD.eval()
-    with tqdm(dataloader) as tepoch:
+    with tqdm(DevicePrefetcher(dataloader, device, channels_last)) as tepoch:
         for iteration, (ref_imgs, dist_imgs, _, _, origin_scores) in enumerate(tepoch):
-            ref_imgs = ref_imgs.to(device)
-            dist_imgs = dist_imgs.to(device)
-
-            # Format batch
-            bs, ncrops, c, h, w = ref_imgs.size()
-
             with torch.no_grad():
                 """
                 Evaluate distorted images
                 """
-                _, _, pred_scores = netD(ref_imgs.view(-1, c, h, w), dist_imgs.view(-1, c, h, w))
-                pred_scores_avg = pred_scores.view(bs, ncrops, -1).mean(1).view(-1)
+                _, _, pred_scores_avg = forward_eval_batch(netD, ref_imgs, dist_imgs, shared_ref, cached,
+                                                        heads=False)
+                pred_scores_avg = pred_scores_avg.view(-1)
 
                 # Record original scores and predict scores
                 record['gt_scores'].append(origin_scores)
-                record['pred_scores'].append(pred_scores_avg.cpu().detach())
+                record['pred_scores'].append(pred_scores_avg.detach())
 
     """
     Calculate correlation coefficient
     """
     result['PLCC'], result['SRCC'], result['KRCC'] = \
         calculate_correlation_coefficient(
-            torch.cat(record['gt_scores']).numpy(),
-            torch.cat(record['pred_scores']).numpy()
+            torch.cat(record['gt_scores']).cpu().numpy(),
+            torch.cat(record['pred_scores']).cpu().numpy()
         )
     return result
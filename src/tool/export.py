@@ -0,0 +1,117 @@
+import json
+import warnings
+import zipfile
+
+import torch
+import torch.nn as nn
+
+# Extra file of a scorer archive describing how it was exported
+SCORER_META = 'scorer.json'
+
+
+class Scorer(nn.Module):
+    """
+    The scoring path of a MultiTask, (reference, distorted) normalized images to quality scores
+    """
+
+    def __init__(self, netD):
+        super(Scorer, self).__init__()
+        self.netD = netD
+
+    def forward(self, ref_img, dist_img):
+        return self.netD(ref_img, dist_img, heads=False)[2]
+
+
+def save_scorer(netD, path, img_size, quantized=False):
+    """
+    Trace the scoring path of ``netD`` on CPU and save it as a TorchScript archive, which eval.py and pred.py run
+    in place of netD weights
+
+    Tracing records the ops the tuples of backbone features go through, so the archive has neither Python control
+    flow nor the tuple interfaces of Backbone, the feature projections and the evaluators left.
+    """
+    scorer = Scorer(netD).eval()
+    # Two images per input, so that the batch dimension is not specialized to 1
+    example = torch.randn(2, 3, *img_size)
+    with torch.no_grad():
+        traced = torch.jit.trace(scorer, (example, example), check_trace=False)
+
+    meta = {'quantized': quantized, 'img_size': list(img_size)}
+    torch.jit.save(traced, path, _extra_files={SCORER_META: json.dumps(meta)})
+
+
+def export_onnx(netD, path, img_size, opset_version=13):
+    """
+    Export the scoring path of ``netD`` to ONNX, with a dynamic batch size, for runtimes outside of PyTorch
+    """
+    scorer = Scorer(netD).eval()
+    example = torch.randn(2, 3, *img_size)
+    with torch.no_grad():
+        torch.onnx.export(scorer, (example, example), path,
+                          input_names=['ref_img', 'dist_img'],
+                          output_names=['score'],
+                          dynamic_axes={'ref_img': {0: 'batch'}, 'dist_img': {0: 'batch'}, 'score': {0: 'batch'}},
+                          opset_version=opset_version)
+
+
+def compile_netD(netD):
+    """
+    Compile the backbone and the evaluator of ``netD`` with torch.compile where this PyTorch provides it
+
+    Compiled submodules prefix their state_dict keys, so only compile a netD whose weights are not saved afterwards.
+    """
+    if not hasattr(torch, 'compile'):
+        warnings.warn(f'torch.compile is not available in PyTorch {torch.__version__}, netD runs eagerly')
+        return netD
+
+    netD.backbone = torch.compile(netD.backbone)
+    netD.evaluator = torch.compile(netD.evaluator)
+    return netD
+
+
+def is_scorer(path):
+    """
+    Whether ``path`` is a scorer archive of save_scorer rather than netD weights
+    """
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any(name.endswith(f'extra/{SCORER_META}') for name in archive.namelist())
+
+
+class ScriptedScorer:
+    """
+    The MultiTask interface of evaluate() and pred.py over a scorer archive, only the scores are computed
+
+    There is no backbone to compute cached features with, and quantized scorers only run on CPU, see ``device``.
+    """
+
+    backbone = None
+
+    def __init__(self, module, device, quantized=False):
+        self.module = module
+        self.device = device
+        self.quantized = quantized
+
+    def eval(self):
+        self.module.eval()
+        return self
+
+    def __call__(self, ref_img, dist_img, heads=True):
+        return None, None, self.module(ref_img, dist_img)
+
+    def forward_shared_reference(self, ref_img, dist_img, heads=True):
+        num_repeats = dist_img.size(0) // ref_img.size(0)
+        return self(ref_img.repeat(num_repeats, 1, 1, 1), dist_img)
+
+
+def load_scorer(path, device=torch.device('cpu')):
+    extra_files = {SCORER_META: ''}
+    module = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    meta = json.loads(extra_files[SCORER_META])
+
+    # INT8 kernels are CPU only
+    if meta['quantized']:
+        device = torch.device('cpu')
+
+    return ScriptedScorer(module.to(device), device, meta['quantized'])
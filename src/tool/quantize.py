@@ -0,0 +1,81 @@
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.quantization import get_default_qconfig, quantize_dynamic
+from torch.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils.data import DataLoader, IterableDataset, Subset
+
+from src.data.transforms import normalize
+from src.modeling.backbone import L2pooling, SplitBatchNorm2d
+
+
+def quantize_evaluator(netD):
+    """
+    Dynamic INT8 for the linear layers of the evaluator (attention outputs, transformer feed-forward, MLPHead)
+
+    The stacked query, key and value projection of the attention layers is a plain parameter and stays in float32.
+    """
+    netD.evaluator = quantize_dynamic(netD.evaluator, {nn.Linear}, dtype=torch.qint8)
+    return netD
+
+
+def calibration_dataloader(dataset, num_pairs, batch_size, seed=0, **kwargs):
+    """
+    DataLoader over ``num_pairs`` pairs of ``dataset`` drawn at random, so that the calibration covers many reference
+    images rather than the first few the pairs are ordered by
+
+    Streamed datasets cannot be indexed and are read in their stored order.
+    """
+    if isinstance(dataset, IterableDataset):
+        warnings.warn('Streamed datasets are calibrated on their first pairs, which may cover few reference images')
+        return DataLoader(dataset, batch_size=batch_size, **kwargs)
+
+    indices = np.random.RandomState(seed).choice(len(dataset), min(num_pairs, len(dataset)), replace=False)
+    return DataLoader(Subset(dataset, np.sort(indices).tolist()), batch_size=batch_size, shuffle=False, **kwargs)
+
+
+def calibration_batches(dataloader, num_pairs):
+    """
+    Normalized reference and distorted crops of the first ``num_pairs`` pairs of an eval dataloader, see
+    calibration_dataloader
+    """
+    seen = 0
+    for ref_imgs, dist_imgs, _, _, _ in dataloader:
+        c, h, w = ref_imgs.shape[-3:]
+        yield normalize(ref_imgs).reshape(-1, c, h, w)
+        yield normalize(dist_imgs).reshape(-1, c, h, w)
+
+        seen += dist_imgs.size(0)
+        if seen >= num_pairs:
+            break
+
+
+def quantize_backbone(netD, batches):
+    """
+    Static INT8 for the convolutions of the backbone, calibrated on ``batches`` of normalized images
+
+    The backbone is traced with torch.fx, which folds every BatchNorm into its convolution. L2pooling of the VGG16
+    backbone (square, blur, square root) stays in float32.
+    """
+    backbone = netD.backbone.eval()
+
+    # SplitBatchNorm2d only matters in train mode, plain BatchNorm2d is what the fusion patterns match
+    for module in backbone.modules():
+        if isinstance(module, SplitBatchNorm2d):
+            module.__class__ = nn.BatchNorm2d
+
+    qconfig_dict = {
+        '': get_default_qconfig(torch.backends.quantized.engine),
+        'object_type': [(L2pooling, None)]
+    }
+    prepared = prepare_fx(backbone, qconfig_dict,
+                          prepare_custom_config_dict={'non_traceable_module_class': [L2pooling]})
+
+    with torch.no_grad():
+        for imgs in batches:
+            prepared(imgs)
+
+    netD.backbone = convert_fx(prepared)
+    return netD
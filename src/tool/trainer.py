@@ -11,10 +11,17 @@ from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
-from src.data.dataset import create_dataloaders
+from src.data.dataset import create_dataloaders, create_feature_dataloader, create_grid_feature_dataloader
+from src.data.features import is_feature_loader
+from src.data.prefetcher import DevicePrefetcher
+from src.data.sampler import shares_reference
+from src.data.transforms import normalize, paired_random_augment
 from src.modeling.module import Generator, MultiTask
-from src.tool.evaluate import calculate_correlation_coefficient
+from src.modeling.precision import grad_scaler
+from src.tool.checkpoint import CHECKPOINT_NAME, get_rng_states, set_rng_states, save_checkpoint
+from src.tool.evaluate import calculate_correlation_coefficient, forward_eval_batch
 from src.tool.log import write_iteration_log, write_epoch_log
+from src.tool.weights import load_weights, needs_pretrained, save_weights
 
 
 def img_transform(img):
@@ -38,22 +45,96 @@ def get_activations(imgs, model):
     return pred.squeeze(3).squeeze(2).cpu().numpy()
 
 
+class ActivationStatistics:
+    """
+    Running count, sum and sum of outer products of Inception activations, all the FID needs of them
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = None
+        self.outer = None
+
+    def update(self, activations):
+        activations = activations.astype(np.float64)
+        if self.sum is None:
+            self.sum = np.zeros(activations.shape[1])
+            self.outer = np.zeros((activations.shape[1], activations.shape[1]))
+
+        self.count += activations.shape[0]
+        self.sum += activations.sum(0)
+        self.outer += activations.T @ activations
+
+    def mean_cov(self):
+        """
+        Mean and unbiased covariance of the activations, as np.mean and np.cov(rowvar=False) would give
+        """
+        mu = self.sum / self.count
+        return mu, (self.outer - self.count * np.outer(mu, mu)) / (self.count - 1)
+
+
+# Entries of the epoch records accumulated over the epoch, the others only describe the last iteration
+EPOCH_RECORD_KEYS = ('gt_scores', 'pred_scores', 'inception_real', 'inception_fake')
+
+
+def epoch_record_state(record):
+    """
+    The accumulated entries of an epoch record, the scores of the epoch so far as a single CPU tensor each
+    """
+    state = {}
+    for key in EPOCH_RECORD_KEYS:
+        if key in record:
+            value = record[key]
+            state[key] = [torch.cat(value).cpu()] if isinstance(value, list) and value else value
+    return state
+
+
+def worker_seed(seed, epoch, start):
+    """
+    Base seed of the DataLoader workers of an epoch that starts at sample ``start``
+    """
+    return int(np.random.SeedSequence([seed, epoch, start]).generate_state(1)[0])
+
+
 class Trainer:
     def __init__(self, cfg):
 
-        self.dataloaders, self.datasets_size = create_dataloaders(cfg)
-
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        self.netD = MultiTask(cfg).to(self.device)
+        self.memory_format = torch.channels_last if cfg.DATASETS.CHANNELS_LAST else torch.contiguous_format
+
+        dataloaders, self.datasets_size = create_dataloaders(cfg)
+        self.dataloaders = {x: DevicePrefetcher(dataloaders[x], self.device, cfg.DATASETS.CHANNELS_LAST)
+                            for x in dataloaders}
+        self.shared_ref = shares_reference(self.dataloaders['val'])
+        self.device_augment = cfg.DATASETS.DEVICE_AUGMENT
+        self.img_size = cfg.DATASETS.IMG_SIZE
+
+        # A resumed netD overwrites the pretrained backbone weights, unless its compact weights leave them out
+        if cfg.TRAIN.RESUME.CHECKPOINT:
+            pretrained = False
+        elif cfg.TRAIN.RESUME.NET_D:
+            pretrained = needs_pretrained(cfg.TRAIN.RESUME.NET_D)
+        else:
+            pretrained = True
+        self.netD = MultiTask(cfg, pretrained=pretrained).to(self.device, memory_format=self.memory_format)
+
+        # The BatchNorm statistics of a fixed backbone still move in train mode, which would invalidate its cached
+        # features every epoch
+        self.cfg = cfg
+        self.cache_val_features = cfg.MODEL.BACKBONE.FEATURE_CACHE and cfg.MODEL.BACKBONE.FIXED and \
+            not any(isinstance(module, nn.modules.batchnorm._BatchNorm) for module in self.netD.backbone.modules())
 
         if cfg.TRAIN.RESUME.NET_D:
-            self.netD.load_state_dict(torch.load(cfg.TRAIN.RESUME.NET_D, map_location='cuda:0'))
+            load_weights(self.netD, cfg.TRAIN.RESUME.NET_D, map_location=self.device)
 
         self.mse_loss = nn.MSELoss()
 
         self.optimizerD = optim.Adam(self.netD.parameters(), lr=cfg.TRAIN.LEARNING_RATE.NET_D)
         self.schedulerD = CosineAnnealingWarmRestarts(self.optimizerD, T_0=1, T_mult=2)
 
+        # Scales the losses of every optimizer under float16 autocast, see MODEL.PRECISION
+        self.scaler = grad_scaler(cfg.MODEL.PRECISION, self.device)
+
         if cfg.TRAIN.START_EPOCH != 0:
             self.schedulerD.step(cfg.TRAIN.START_EPOCH)
 
@@ -64,27 +145,153 @@ class Trainer:
 
         self.start_epoch = cfg.TRAIN.START_EPOCH
         self.num_epoch = cfg.TRAIN.NUM_EPOCHS
-        self.iteration = self.start_epoch * math.ceil(self.datasets_size['train'] / cfg.DATASETS.BATCH_SIZE)
+        self.batch_size = cfg.DATASETS.BATCH_SIZE
+        self.iteration = self.start_epoch * math.ceil(self.datasets_size['train'] / self.batch_size)
         self.weight_dir = cfg.TRAIN.WEIGHT_DIR
+        self.weight_format = cfg.TRAIN.WEIGHT_FORMAT
+        self.omit_frozen = cfg.TRAIN.OMIT_FROZEN
+        self.half_evaluator = cfg.TRAIN.HALF_EVALUATOR
+
+        # Mid-epoch checkpoints, see save_checkpoint
+        self.seed = cfg.TRAIN.SEED
+        self.checkpoint_interval = cfg.TRAIN.CHECKPOINT_INTERVAL if self.weight_dir else 0
+        self.resume_checkpoint = cfg.TRAIN.RESUME.CHECKPOINT
+        self.epoch = self.start_epoch
+        self.epoch_iteration = 0
+        self.epoch_state = None
 
     def train(self):
-        for epoch in range(self.start_epoch, self.start_epoch + self.num_epoch):
-            print(f'Epoch {epoch + 1}/{self.start_epoch + self.num_epoch}')
+        end_epoch = self.start_epoch + self.num_epoch
+        if self.resume_checkpoint:
+            self.load_checkpoint(self.resume_checkpoint)
+
+        for epoch in range(self.epoch, end_epoch):
+            print(f'Epoch {epoch + 1}/{end_epoch}')
             print('-' * 10)
 
+            self.epoch = epoch
+
+            # Reshuffles the training order, or the shard order and buffer of a ShardedDataset
+            train_loader = self.dataloaders['train'].dataloader
+            for shuffled in (train_loader.sampler, train_loader.dataset):
+                if hasattr(shuffled, 'set_epoch'):
+                    shuffled.set_epoch(epoch)
+
+            # Skips the iterations already done before the checkpoint
+            if hasattr(train_loader.sampler, 'load_state_dict'):
+                train_loader.sampler.load_state_dict({'epoch': epoch, 'start': self.epoch_iteration * self.batch_size})
+            else:
+                self.epoch_iteration = 0
+                self.epoch_state = None
+
+            # The random augmentations of the workers only depend on the seed and where the epoch starts
+            if train_loader.generator is not None:
+                train_loader.generator.manual_seed(worker_seed(self.seed, epoch, self.epoch_iteration))
+
             results = {
                 'train': self.epoch_train(),
                 'val': self.epoch_eval()
             }
 
+            self.epoch_iteration = 0
+            self.epoch_state = None
+
             self.schedulerD.step()
 
             self.write_epoch_log(results, epoch + 1)
 
             if self.weight_dir:
                 self.save_weight(epoch + 1)
+                if self.checkpoint_interval:
+                    self.epoch = epoch + 1
+                    self.save_checkpoint()
         self.writer.close()
 
+    def checkpoint_modules(self):
+        """
+        Modules, optimizers and schedulers whose state_dict goes into a checkpoint
+        """
+        return {
+            'netD': self.netD,
+            'optimizerD': self.optimizerD,
+            'schedulerD': self.schedulerD,
+            'scaler': self.scaler
+        }
+
+    def save_checkpoint(self, record=None, result=None):
+        """
+        Save everything needed to carry on from the current iteration, including the accumulated records of the epoch
+        (see epoch_record_state), whose size does not grow with the iterations but for one score per pair
+        """
+        state = {name: module.state_dict() for name, module in self.checkpoint_modules().items()}
+        state.update({
+            'epoch': self.epoch,
+            'epoch_iteration': self.epoch_iteration,
+            'iteration': self.iteration,
+            'epoch_state': {'record': epoch_record_state(record), 'result': result} if record is not None else None,
+            'rng_states': get_rng_states()
+        })
+        save_checkpoint(state, os.path.join(self.weight_dir, CHECKPOINT_NAME))
+
+    def load_checkpoint(self, path):
+        state = torch.load(path, map_location=self.device)
+
+        for name, module in self.checkpoint_modules().items():
+            # Checkpoints from before mixed precision have no scaler, and a disabled GradScaler saves an empty state
+            if name == 'scaler' and not state.get(name):
+                continue
+            module.load_state_dict(state[name])
+
+        self.epoch = state['epoch']
+        self.epoch_iteration = state['epoch_iteration']
+        self.iteration = state['iteration']
+        self.epoch_state = state['epoch_state']
+        set_rng_states(state['rng_states'])
+
+    def resume_epoch(self, record, result):
+        """
+        The record and result of the epoch restored from a checkpoint, or the given fresh ones
+        """
+        if self.epoch_state is None:
+            return record, result
+
+        record.update({key: value for key, value in self.epoch_state['record'].items() if key in record})
+        return record, self.epoch_state['result']
+
+    def end_iteration(self, record, result):
+        self.iteration += 1
+        self.epoch_iteration += 1
+
+        if self.checkpoint_interval and self.iteration % self.checkpoint_interval == 0:
+            self.save_checkpoint(record, result)
+
+    def format_train_batch(self, ref_imgs, dist_imgs):
+        """
+        Augment on the device the uint8 training pairs of DATASETS.DEVICE_AUGMENT
+        """
+        if self.device_augment:
+            return paired_random_augment(ref_imgs, dist_imgs, self.img_size)
+        return ref_imgs, dist_imgs
+
+    def forward_eval(self, ref_imgs, dist_imgs, heads=True):
+        """
+        netD on (bs, ncrops, c, h, w) reference crops and flattened distorted crops of a val batch
+        """
+        if self.shared_ref:
+            return self.netD.forward_shared_reference(ref_imgs[0], dist_imgs, heads=heads)
+        return self.netD(ref_imgs.flatten(0, 1), dist_imgs, heads=heads)
+
+    def val_loader(self):
+        """
+        The val batches, as cached backbone features when MODEL.BACKBONE.FEATURE_CACHE applies, see FeatureStore
+        """
+        if self.cache_val_features:
+            dataloader = create_feature_dataloader(self.cfg, self.dataloaders['val'].dataloader.dataset,
+                                                   self.netD.backbone, self.device)
+            if dataloader is not None:
+                return DevicePrefetcher(dataloader, self.device, self.dataloaders['val'].channels_last)
+        return self.dataloaders['val']
+
     def epoch_train(self):
         pass
 
@@ -94,8 +301,19 @@ class Trainer:
     def write_epoch_log(self, results, epoch):
         pass
 
+    def write_weights(self, module, name):
+        """
+        Save ``module`` as WEIGHT_DIR/<name>.pth or, with TRAIN.WEIGHT_FORMAT 'compact', WEIGHT_DIR/<name>.safetensors
+        """
+        if self.weight_format == 'compact':
+            save_weights(module, os.path.join(self.weight_dir, f'{name}.safetensors'),
+                         omit_frozen=self.omit_frozen,
+                         half_prefixes=('evaluator.',) if self.half_evaluator else ())
+        else:
+            torch.save(module.state_dict(), os.path.join(self.weight_dir, f'{name}.pth'))
+
     def save_weight(self, epoch):
-        torch.save(self.netD.state_dict(), os.path.join(self.weight_dir, f'netD_epoch{epoch}.pth'))
+        self.write_weights(self.netD, f'netD_epoch{epoch}')
 
 
 class TrainerPhase1(Trainer):
@@ -110,10 +328,11 @@ class TrainerPhase1(Trainer):
         self.ce_loss = nn.CrossEntropyLoss()
 
         self.inception = InceptionV3([InceptionV3.BLOCK_INDEX_BY_DIM[cfg.MODEL.INCEPTION_DIMS]]).to(self.device)
-        self.netG = Generator(img_shape=(3, cfg.DATASETS.IMG_SIZE[0], cfg.DATASETS.IMG_SIZE[1])).to(self.device)
+        self.netG = Generator(img_shape=(3, cfg.DATASETS.IMG_SIZE[0], cfg.DATASETS.IMG_SIZE[1]),
+                              precision=cfg.MODEL.PRECISION).to(self.device, memory_format=self.memory_format)
 
         if cfg.TRAIN.RESUME.NET_G:
-            self.netG.load_state_dict(torch.load(cfg.TRAIN.RESUME.NET_G))
+            load_weights(self.netG, cfg.TRAIN.RESUME.NET_G, map_location=self.device)
 
         self.optimizerG = optim.Adam(self.netG.parameters(), lr=cfg.TRAIN.LEARNING_RATE.NET_G)
         self.schedulerG = CosineAnnealingWarmRestarts(self.optimizerG, T_0=1, T_mult=2)
@@ -126,8 +345,8 @@ class TrainerPhase1(Trainer):
         record = {
             'gt_scores': [],
             'pred_scores': [],
-            'inception_real_pred': [],
-            'inception_fake_pred': []
+            'inception_real': ActivationStatistics(),
+            'inception_fake': ActivationStatistics()
         }
 
         result = {
@@ -138,15 +357,15 @@ class TrainerPhase1(Trainer):
             'cont': 0
         }
 
+        record, result = self.resume_epoch(record, result)
+
         self.netG.train()
         self.netD.train()
 
         with tqdm(self.dataloaders['train']) as tepoch:
             for ref_imgs, dist_imgs, scores, categories, origin_scores in tepoch:
-                ref_imgs = ref_imgs.to(self.device)
-                dist_imgs = dist_imgs.to(self.device)
-                scores = scores.to(self.device).float()
-                categories = categories.to(self.device)
+                ref_imgs, dist_imgs = self.format_train_batch(ref_imgs, dist_imgs)
+                scores = scores.float()
 
                 # Format batch
                 bs = ref_imgs.size(0)
@@ -180,7 +399,7 @@ class TrainerPhase1(Trainer):
 
                 # Record original scores and predict scores
                 record['gt_scores'].append(origin_scores)
-                record['pred_scores'].append(pred_scores.cpu().detach())
+                record['pred_scores'].append(pred_scores.detach())
 
                 """
                 Discriminator with fake image
@@ -211,8 +430,8 @@ class TrainerPhase1(Trainer):
                 errD = errD_real + errD_fake
                 record['errD'] = errD.item()
 
-                errD.backward()
-                self.optimizerD.step()
+                self.scaler.scale(errD).backward()
+                self.scaler.step(self.optimizerD)
 
                 """
                 Generator
@@ -243,8 +462,9 @@ class TrainerPhase1(Trainer):
 
                 record['errG'] = errG.item()
 
-                errG.backward()
-                self.optimizerG.step()
+                self.scaler.scale(errG).backward()
+                self.scaler.step(self.optimizerG)
+                self.scaler.update()
 
                 record['real_imgs'] = img_transform(dist_imgs.cpu().detach())
                 record['fake_imgs'] = img_transform(fake_imgs.cpu().detach())
@@ -253,8 +473,8 @@ class TrainerPhase1(Trainer):
                 Record activations
                 """
                 with torch.no_grad():
-                    record['inception_real_pred'].append(get_activations(dist_imgs, self.inception))
-                    record['inception_fake_pred'].append(get_activations(fake_imgs.detach(), self.inception))
+                    record['inception_real'].update(get_activations(dist_imgs, self.inception))
+                    record['inception_fake'].update(get_activations(fake_imgs.detach(), self.inception))
 
                 """
                 Show logs
@@ -278,7 +498,7 @@ class TrainerPhase1(Trainer):
                 result['fake_qual'] += record['errG_qual'] * bs
                 result['cont'] += record['errG_cont'] * bs
 
-                self.iteration += 1
+                self.end_iteration(record, result)
 
         result['real_clf'] /= self.datasets_size['train']
         result['real_qual'] /= self.datasets_size['train']
@@ -289,11 +509,8 @@ class TrainerPhase1(Trainer):
         """
         Calculate FID score
         """
-        real_mu = np.mean(np.concatenate(record['inception_real_pred']), axis=0)
-        fake_mu = np.mean(np.concatenate(record['inception_fake_pred']), axis=0)
-
-        real_sigma = np.cov(np.concatenate(record['inception_real_pred']), rowvar=False)
-        fake_sigma = np.cov(np.concatenate(record['inception_fake_pred']), rowvar=False)
+        real_mu, real_sigma = record['inception_real'].mean_cov()
+        fake_mu, fake_sigma = record['inception_fake'].mean_cov()
 
         result['FID'] = calculate_frechet_distance(real_mu, real_sigma, fake_mu, fake_sigma)
 
@@ -302,8 +519,8 @@ class TrainerPhase1(Trainer):
         """
         result['PLCC'], result['SRCC'], result['KRCC'] = \
             calculate_correlation_coefficient(
-                torch.cat(record['gt_scores']).numpy(),
-                torch.cat(record['pred_scores']).numpy()
+                torch.cat(record['gt_scores']).cpu().numpy(),
+                torch.cat(record['pred_scores']).cpu().numpy()
             )
 
         return result
@@ -322,26 +539,26 @@ class TrainerPhase1(Trainer):
         self.netG.eval()
         self.netD.eval()
 
-        for ref_imgs, dist_imgs, scores, categories, origin_scores in tqdm(self.dataloaders['val']):
-            ref_imgs = ref_imgs.to(self.device)
-            dist_imgs = dist_imgs.to(self.device)
-            scores = scores.to(self.device).float()
-            categories = categories.to(self.device)
+        val_loader = self.val_loader()
+        cached = is_feature_loader(val_loader.dataloader)
+
+        for ref_imgs, dist_imgs, scores, categories, origin_scores in tqdm(val_loader):
+            scores = scores.float()
 
             # Format batch
-            bs, ncrops, c, h, w = ref_imgs.size()
+            bs = scores.size(0)
 
             with torch.no_grad():
-                _, pred_categories, pred_scores = self.netD(ref_imgs.view(-1, c, h, w), dist_imgs.view(-1, c, h, w))
-                pred_scores_avg = pred_scores.view(bs, ncrops, -1).mean(1).view(-1)
-                pred_categories_avg = pred_categories.view(bs, ncrops, -1).mean(1)
+                _, pred_categories_avg, pred_scores_avg = forward_eval_batch(self.netD, ref_imgs, dist_imgs,
+                                                                             self.shared_ref, cached)
+                pred_scores_avg = pred_scores_avg.view(-1)
 
                 record['errD_real_clf'] = self.ce_loss(pred_categories_avg, categories).item()
                 record['errD_real_qual'] = self.mse_loss(pred_scores_avg, scores).item()
 
             # Record original scores and predict scores
             record['gt_scores'].append(origin_scores)
-            record['pred_scores'].append(pred_scores_avg.cpu().detach())
+            record['pred_scores'].append(pred_scores_avg.detach())
 
             """
             Record epoch loss
@@ -357,8 +574,8 @@ class TrainerPhase1(Trainer):
         """
         result['PLCC'], result['SRCC'], result['KRCC'] = \
             calculate_correlation_coefficient(
-                torch.cat(record['gt_scores']).numpy(),
-                torch.cat(record['pred_scores']).numpy()
+                torch.cat(record['gt_scores']).cpu().numpy(),
+                torch.cat(record['pred_scores']).cpu().numpy()
             )
 
         return result
@@ -366,9 +583,18 @@ class TrainerPhase1(Trainer):
     def write_epoch_log(self, results, epoch):
         write_epoch_log(self.writer, results, epoch)
 
+    def checkpoint_modules(self):
+        modules = super(TrainerPhase1, self).checkpoint_modules()
+        modules.update({
+            'netG': self.netG,
+            'optimizerG': self.optimizerG,
+            'schedulerG': self.schedulerG
+        })
+        return modules
+
     def save_weight(self, epoch):
         super(TrainerPhase1, self).save_weight(epoch)
-        torch.save(self.netG.state_dict(), os.path.join(self.weight_dir, f'netG_epoch{epoch}.pth'))
+        self.write_weights(self.netG, f'netG_epoch{epoch}')
 
 
 class TrainerPhase2(Trainer):
@@ -377,9 +603,10 @@ class TrainerPhase2(Trainer):
 
         self.latent_dim = cfg.MODEL.LATENT_DIM
 
-        self.netG = Generator(img_shape=(3, cfg.DATASETS.IMG_SIZE[0], cfg.DATASETS.IMG_SIZE[1])).to(self.device)
+        self.netG = Generator(img_shape=(3, cfg.DATASETS.IMG_SIZE[0], cfg.DATASETS.IMG_SIZE[1]),
+                              precision=cfg.MODEL.PRECISION).to(self.device, memory_format=self.memory_format)
         if cfg.TRAIN.RESUME.NET_G:
-            self.netG.load_state_dict(torch.load(cfg.TRAIN.RESUME.NET_G))
+            load_weights(self.netG, cfg.TRAIN.RESUME.NET_G, map_location=self.device)
         self.netG.eval()
 
     def epoch_train(self):
@@ -393,14 +620,14 @@ class TrainerPhase2(Trainer):
             'fake_loss': 0
         }
 
+        record, result = self.resume_epoch(record, result)
+
         self.netD.train()
 
         with tqdm(self.dataloaders['train']) as tepoch:
             for iteration, (ref_imgs, dist_imgs, scores, categories, origin_scores) in enumerate(tepoch):
-                ref_imgs = ref_imgs.to(self.device)
-                dist_imgs = dist_imgs.to(self.device)
-                scores = scores.to(self.device).float()
-                categories = categories.to(self.device)
+                ref_imgs, dist_imgs = self.format_train_batch(ref_imgs, dist_imgs)
+                scores = scores.float()
 
                 # Format batch
                 bs = ref_imgs.size(0)
@@ -410,13 +637,13 @@ class TrainerPhase2(Trainer):
                 """
                 Deal with Real Distorted Images
                 """
-                _, _, pred_scores = self.netD(ref_imgs, dist_imgs)
+                _, _, pred_scores = self.netD(ref_imgs, dist_imgs, heads=False)
 
                 real_loss = self.mse_loss(pred_scores, scores)
 
                 # Record original scores and predict scores
                 record['gt_scores'].append(origin_scores)
-                record['pred_scores'].append(pred_scores.cpu().detach())
+                record['pred_scores'].append(pred_scores.detach())
 
                 """
                 Deal with Fake Distorted Images
@@ -429,13 +656,14 @@ class TrainerPhase2(Trainer):
                                       scores.view(bs, -1),
                                       categories.view(bs, -1).float())
 
-                _, _, pred_scores = self.netD(ref_imgs, fake_imgs.detach())
+                _, _, pred_scores = self.netD(ref_imgs, fake_imgs.detach(), heads=False)
 
                 fake_loss = self.mse_loss(pred_scores, scores)
 
                 total_loss = real_loss + fake_loss
-                total_loss.backward()
-                self.optimizerD.step()
+                self.scaler.scale(total_loss).backward()
+                self.scaler.step(self.optimizerD)
+                self.scaler.update()
 
                 result['real_loss'] += real_loss.item() * bs
                 result['fake_loss'] += fake_loss.item() * bs
@@ -447,6 +675,8 @@ class TrainerPhase2(Trainer):
                     'Total Loss': total_loss.item()
                 })
 
+                self.end_iteration(record, result)
+
         result['real_loss'] /= self.datasets_size['train']
         result['fake_loss'] /= self.datasets_size['train']
 
@@ -455,8 +685,8 @@ class TrainerPhase2(Trainer):
         """
         result['PLCC'], result['SRCC'], result['KRCC'] = \
             calculate_correlation_coefficient(
-                torch.cat(record['gt_scores']).numpy(),
-                torch.cat(record['pred_scores']).numpy()
+                torch.cat(record['gt_scores']).cpu().numpy(),
+                torch.cat(record['pred_scores']).cpu().numpy()
             )
 
         return result
@@ -477,10 +707,9 @@ class TrainerPhase2(Trainer):
 
         with tqdm(self.dataloaders['val']) as tepoch:
             for ref_imgs, dist_imgs, scores, categories, origin_scores in tepoch:
-                ref_imgs = ref_imgs.to(self.device)
-                dist_imgs = dist_imgs.to(self.device)
-                scores = scores.to(self.device).float()
-                categories = categories.to(self.device)
+                ref_imgs = normalize(ref_imgs)
+                dist_imgs = normalize(dist_imgs)
+                scores = scores.float()
 
                 # Format batch
                 bs, ncrops, c, h, w = ref_imgs.size()
@@ -489,14 +718,14 @@ class TrainerPhase2(Trainer):
                     """
                     Evaluate real distorted images
                     """
-                    _, _, pred_scores = self.netD(ref_imgs.view(-1, c, h, w), dist_imgs.view(-1, c, h, w))
+                    _, _, pred_scores = self.forward_eval(ref_imgs, dist_imgs.view(-1, c, h, w), heads=False)
                     pred_scores_avg = pred_scores.view(bs, ncrops, -1).mean(1).view(-1)
 
                     real_loss = self.mse_loss(pred_scores_avg, scores)
 
                     # Record original scores and predict scores
                     record['gt_scores'].append(origin_scores)
-                    record['pred_scores'].append(pred_scores_avg.cpu().detach())
+                    record['pred_scores'].append(pred_scores_avg.detach())
 
                     """
                     Evaluate fake distorted images
@@ -510,7 +739,7 @@ class TrainerPhase2(Trainer):
                         categories.repeat_interleave(ncrops).view(bs * ncrops, -1).float()
                     )
 
-                    _, _, pred_scores = self.netD(ref_imgs.view(-1, c, h, w), fake_imgs.detach())
+                    _, _, pred_scores = self.forward_eval(ref_imgs, fake_imgs.detach(), heads=False)
                     pred_scores_avg = pred_scores.view(bs, ncrops, -1).mean(1).view(-1)
 
                     fake_loss = self.mse_loss(pred_scores_avg, scores)
@@ -532,8 +761,8 @@ class TrainerPhase2(Trainer):
         """
         result['PLCC'], result['SRCC'], result['KRCC'] = \
             calculate_correlation_coefficient(
-                torch.cat(record['gt_scores']).numpy(),
-                torch.cat(record['pred_scores']).numpy()
+                torch.cat(record['gt_scores']).cpu().numpy(),
+                torch.cat(record['pred_scores']).cpu().numpy()
             )
 
         return result
@@ -558,6 +787,14 @@ class TrainerPhase3(Trainer):
     def __init__(self, cfg):
         super(TrainerPhase3, self).__init__(cfg)
 
+        # The backbone never runs in train mode then, so its val features can be cached too
+        self.feature_grid = cfg.TRAIN.FEATURE_GRID.ENABLED
+        if self.feature_grid:
+            dataloader = create_grid_feature_dataloader(cfg, self.dataloaders['train'].dataloader.dataset,
+                                                        self.netD.backbone, self.device)
+            self.dataloaders['train'] = DevicePrefetcher(dataloader, self.device, cfg.DATASETS.CHANNELS_LAST)
+            self.cache_val_features = True
+
     def epoch_train(self):
         record = {
             'gt_scores': [],
@@ -568,32 +805,38 @@ class TrainerPhase3(Trainer):
             'loss': 0
         }
 
+        record, result = self.resume_epoch(record, result)
+
         self.netD.train()
 
         with tqdm(self.dataloaders['train']) as tepoch:
             for ref_imgs, dist_imgs, scores, categories, origin_scores in tepoch:
-                ref_imgs = ref_imgs.to(self.device)
-                dist_imgs = dist_imgs.to(self.device)
-                scores = scores.to(self.device).float()
+                scores = scores.float()
 
                 # Format batch
-                bs = ref_imgs.size(0)
+                bs = scores.size(0)
 
                 self.optimizerD.zero_grad()
 
                 """
                 Deal with Real Distorted Images
                 """
-                _, _, pred_scores = self.netD(ref_imgs, dist_imgs)
+                if self.feature_grid:
+                    # ref_imgs and dist_imgs hold cached backbone features of one grid crop per pair
+                    _, _, pred_scores = self.netD.forward_features(ref_imgs, dist_imgs, heads=False)
+                else:
+                    ref_imgs, dist_imgs = self.format_train_batch(ref_imgs, dist_imgs)
+                    _, _, pred_scores = self.netD(ref_imgs, dist_imgs, heads=False)
 
                 loss = self.mse_loss(pred_scores, scores)
 
                 # Record original scores and predict scores
                 record['gt_scores'].append(origin_scores)
-                record['pred_scores'].append(pred_scores.cpu().detach())
+                record['pred_scores'].append(pred_scores.detach())
 
-                loss.backward()
-                self.optimizerD.step()
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizerD)
+                self.scaler.update()
 
                 result['loss'] += loss.item() * bs
 
@@ -602,6 +845,8 @@ class TrainerPhase3(Trainer):
                     'Loss': loss.item()
                 })
 
+                self.end_iteration(record, result)
+
         result['loss'] /= self.datasets_size['train']
 
         """
@@ -609,8 +854,8 @@ class TrainerPhase3(Trainer):
         """
         result['PLCC'], result['SRCC'], result['KRCC'] = \
             calculate_correlation_coefficient(
-                torch.cat(record['gt_scores']).numpy(),
-                torch.cat(record['pred_scores']).numpy()
+                torch.cat(record['gt_scores']).cpu().numpy(),
+                torch.cat(record['pred_scores']).cpu().numpy()
             )
 
         return result
@@ -627,27 +872,29 @@ class TrainerPhase3(Trainer):
 
         self.netD.eval()
 
-        with tqdm(self.dataloaders['val']) as tepoch:
+        val_loader = self.val_loader()
+        cached = is_feature_loader(val_loader.dataloader)
+
+        with tqdm(val_loader) as tepoch:
             for ref_imgs, dist_imgs, scores, categories, origin_scores in tepoch:
-                ref_imgs = ref_imgs.to(self.device)
-                dist_imgs = dist_imgs.to(self.device)
-                scores = scores.to(self.device).float()
+                scores = scores.float()
 
                 # Format batch
-                bs, ncrops, c, h, w = ref_imgs.size()
+                bs = scores.size(0)
 
                 with torch.no_grad():
                     """
                     Evaluate real distorted images
                     """
-                    _, _, pred_scores = self.netD(ref_imgs.view(-1, c, h, w), dist_imgs.view(-1, c, h, w))
-                    pred_scores_avg = pred_scores.view(bs, ncrops, -1).mean(1).view(-1)
+                    _, _, pred_scores_avg = forward_eval_batch(self.netD, ref_imgs, dist_imgs, self.shared_ref, cached,
+                                                               heads=False)
+                    pred_scores_avg = pred_scores_avg.view(-1)
 
                     loss = self.mse_loss(pred_scores_avg, scores)
 
                     # Record original scores and predict scores
                     record['gt_scores'].append(origin_scores)
-                    record['pred_scores'].append(pred_scores_avg.cpu().detach())
+                    record['pred_scores'].append(pred_scores_avg.detach())
 
                 result['loss'] += loss.item() * bs
 
@@ -663,8 +910,8 @@ class TrainerPhase3(Trainer):
         """
         result['PLCC'], result['SRCC'], result['KRCC'] = \
             calculate_correlation_coefficient(
-                torch.cat(record['gt_scores']).numpy(),
-                torch.cat(record['pred_scores']).numpy()
+                torch.cat(record['gt_scores']).cpu().numpy(),
+                torch.cat(record['pred_scores']).cpu().numpy()
             )
 
         return result
@@ -0,0 +1,173 @@
+"""
+Compact weights files, written and read by hand in a subset of the safetensors layout rather than with the safetensors
+library: an 8-byte little-endian header size, a JSON header giving the dtype, shape and byte range of every tensor, then
+the raw tensor bytes. Only the dtypes of TORCH_TO_CODE are supported.
+"""
+import hashlib
+import json
+import struct
+
+import numpy as np
+import torch
+
+TORCH_TO_CODE = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL'
+}
+CODE_TO_TORCH = {code: dtype for dtype, code in TORCH_TO_CODE.items()}
+# NumPy has no bfloat16, its bits are read as int16 and viewed as bfloat16 by torch
+CODE_TO_NUMPY = {
+    'F64': np.float64,
+    'F32': np.float32,
+    'F16': np.float16,
+    'BF16': np.int16,
+    'I64': np.int64,
+    'I32': np.int32,
+    'U8': np.uint8,
+    'BOOL': np.bool_
+}
+
+
+def frozen_backbone_parameters(module):
+    """
+    Names of the parameters of ``module.backbone`` that are not trained, so they keep their pretrained values
+    """
+    if not hasattr(module, 'backbone'):
+        return []
+    return [f'backbone.{name}' for name, parameter in module.backbone.named_parameters() if not parameter.requires_grad]
+
+
+def tensors_digest(state_dict, names):
+    digest = hashlib.sha1()
+    for name in names:
+        digest.update(name.encode())
+        digest.update(state_dict[name].detach().float().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def save_weights(module, path, omit_frozen=True, half_prefixes=()):
+    """
+    Save the state_dict of ``module`` in the compact format
+
+    With ``omit_frozen`` the frozen backbone parameters are left out and only referenced by the name of the
+    pretrained backbone and a digest of their values, the buffers (e.g. BatchNorm statistics) are always kept. Floating
+    point tensors whose name starts with one of ``half_prefixes`` are stored in float16 and cast back on load.
+    """
+    state_dict = module.state_dict()
+
+    omitted = frozen_backbone_parameters(module) if omit_frozen else []
+    metadata = {'format': 'pt'}
+    if omitted:
+        metadata['pretrained'] = module.backbone.pretrained_name
+        metadata['omitted'] = json.dumps(omitted)
+        metadata['omitted_sha1'] = tensors_digest(state_dict, omitted)
+
+    header = {'__metadata__': metadata}
+    upcast = {}
+    tensors = []
+    offset = 0
+    for name, tensor in state_dict.items():
+        if name in omitted:
+            continue
+
+        tensor = tensor.detach().cpu().contiguous()
+        if tensor.is_floating_point() and tensor.dtype != torch.float16 and name.startswith(tuple(half_prefixes)):
+            upcast[name] = TORCH_TO_CODE[tensor.dtype]
+            tensor = tensor.half()
+
+        data = (tensor.view(torch.int16) if tensor.dtype == torch.bfloat16 else tensor).numpy().tobytes()
+        header[name] = {'dtype': TORCH_TO_CODE[tensor.dtype], 'shape': list(tensor.shape),
+                        'data_offsets': [offset, offset + len(data)]}
+        tensors.append(data)
+        offset += len(data)
+
+    if upcast:
+        metadata['upcast'] = json.dumps(upcast)
+
+    # The tensor bytes start 8-byte aligned
+    header = json.dumps(header).encode()
+    header += b' ' * (-len(header) % 8)
+
+    with open(path, 'wb') as handle:
+        handle.write(struct.pack('<Q', len(header)))
+        handle.write(header)
+        for data in tensors:
+            handle.write(data)
+
+
+def is_compact(path):
+    with open(path, 'rb') as handle:
+        start = handle.read(9)
+    return len(start) == 9 and start[8:9] == b'{'
+
+
+def read_header(path):
+    with open(path, 'rb') as handle:
+        header_size = struct.unpack('<Q', handle.read(8))[0]
+        header = json.loads(handle.read(header_size))
+    return header, 8 + header_size
+
+
+def needs_pretrained(path):
+    """
+    Whether the weights at ``path`` leave out backbone parameters that have to come from the pretrained backbone
+    """
+    return is_compact(path) and 'omitted' in read_header(path)[0].get('__metadata__', {})
+
+
+def read_weights(path):
+    """
+    Tensors and metadata of a compact weights file, the tensors are memory mapped rather than deserialized
+    """
+    header, data_start = read_header(path)
+    metadata = header.pop('__metadata__', {})
+    upcast = json.loads(metadata.get('upcast', '{}'))
+
+    # Copy-on-write, so that the arrays are writable as torch expects, while unread pages stay on disk
+    buffer = np.memmap(path, dtype=np.uint8, mode='c', offset=data_start) if header else None
+
+    state_dict = {}
+    for name, info in header.items():
+        start, end = info['data_offsets']
+        array = buffer[start:end].view(CODE_TO_NUMPY[info['dtype']]).reshape(info['shape'])
+        if array.ctypes.data % array.itemsize:
+            # Tensors stored after an odd-sized float16 tensor may be misaligned
+            array = np.array(array)
+        tensor = torch.from_numpy(array)
+        if info['dtype'] == 'BF16':
+            tensor = tensor.view(torch.bfloat16)
+        if name in upcast:
+            tensor = tensor.to(CODE_TO_TORCH[upcast[name]])
+        state_dict[name] = tensor
+
+    return state_dict, metadata
+
+
+def load_weights(module, path, map_location=None):
+    """
+    Load weights saved either by ``torch.save(module.state_dict())`` or by ``save_weights`` into ``module``
+
+    ``module`` must have been built with its pretrained backbone when the file leaves out the frozen backbone
+    parameters, see ``needs_pretrained``.
+    """
+    if not is_compact(path):
+        module.load_state_dict(torch.load(path, map_location=map_location))
+        return
+
+    state_dict, metadata = read_weights(path)
+
+    omitted = json.loads(metadata.get('omitted', '[]'))
+    if omitted and tensors_digest(module.state_dict(), omitted) != metadata['omitted_sha1']:
+        raise ValueError(f'{path} leaves out frozen backbone parameters equal to the pretrained '
+                         f'{metadata["pretrained"]} weights, but the model backbone holds other values')
+
+    missing_keys, unexpected_keys = module.load_state_dict(state_dict, strict=False)
+    if set(missing_keys) != set(omitted) or unexpected_keys:
+        raise RuntimeError(f'Error(s) in loading {path}: missing keys {sorted(set(missing_keys) - set(omitted))}, '
+                           f'unexpected keys {unexpected_keys}')
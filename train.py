@@ -10,7 +10,8 @@ def main(cfg):
     if cfg.TRAIN.WEIGHT_DIR and not os.path.isdir(cfg.TRAIN.WEIGHT_DIR):
         os.makedirs(cfg.TRAIN.WEIGHT_DIR)
 
-    if cfg.TRAIN.LOG_DIR and os.path.isdir(cfg.TRAIN.LOG_DIR) and not cfg.TRAIN.RESUME.NET_D and not cfg.TRAIN.RESUME.NET_G:
+    resume = cfg.TRAIN.RESUME.NET_D or cfg.TRAIN.RESUME.NET_G or cfg.TRAIN.RESUME.CHECKPOINT
+    if cfg.TRAIN.LOG_DIR and os.path.isdir(cfg.TRAIN.LOG_DIR) and not resume:
         shutil.rmtree(cfg.TRAIN.LOG_DIR)
 
     if cfg.TRAIN.PHASE == 1:
@@ -39,6 +40,12 @@ if __name__ == '__main__':
     assert cfg.MODEL.BACKBONE.NAME in ['VGG16', 'InceptionResNetV2']
     assert cfg.MODEL.BACKBONE.FEAT_LEVEL in ['low', 'medium', 'high', 'mixed', 'reduced mixed']
     assert cfg.MODEL.EVALUATOR in ['IQT', 'DISTS', 'Transformer']
+    assert cfg.MODEL.PRECISION in ['fp32', 'bf16', 'fp16']
+    assert cfg.DATASETS.BACKEND in ['image', 'packed', 'shards']
+    assert cfg.TRAIN.WEIGHT_FORMAT in ['pth', 'compact']
+    assert not cfg.TRAIN.FEATURE_GRID.ENABLED or \
+           (cfg.TRAIN.PHASE == 3 and cfg.MODEL.BACKBONE.FIXED and cfg.MODEL.BACKBONE.FEATURE_CACHE and
+            cfg.DATASETS.BACKEND != 'shards')
 
     cfg.freeze()
 